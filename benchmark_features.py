@@ -0,0 +1,84 @@
+import argparse
+import logging
+import os
+import random
+import time
+
+from bertmodel.datasets._image_features_reader import ImageFeaturesH5Reader
+from bertmodel.datasets._feature_store import ImageFeaturesMmapReader
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def store_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def benchmark(reader, image_ids, batch_size):
+    """Decoded float32 MB/s of `__getitem__` and of `get_many` over `image_ids`."""
+    decoded_bytes = 0
+    start = time.perf_counter()
+    for image_id in image_ids:
+        features, num_boxes, image_location, image_location_ori = reader[image_id]
+        decoded_bytes += num_boxes * features.shape[1] * 4
+    single = decoded_bytes / float(1 << 20) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, len(image_ids), batch_size):
+        reader.get_many(image_ids[i:i + batch_size])
+    batched = decoded_bytes / float(1 << 20) / (time.perf_counter() - start)
+    return single, batched
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--lmdb_path",
+        required=True,
+        type=str,
+        help="The lmdb feature store, read through the pickle + base64 path.",
+    )
+    parser.add_argument(
+        "--stores",
+        default=[],
+        nargs="*",
+        type=str,
+        help="Memory-mapped stores of the same images written by convert_features.py.",
+    )
+    parser.add_argument(
+        "--num_images", default=1000, type=int, help="Number of random images to read."
+    )
+    parser.add_argument(
+        "--batch_size", default=32, type=int, help="Number of images per get_many call."
+    )
+    parser.add_argument("--seed", type=int, default=42, help="random seed for the image sample")
+    args = parser.parse_args()
+
+    readers = [(args.lmdb_path, ImageFeaturesH5Reader(args.lmdb_path))]
+    readers += [(path, ImageFeaturesMmapReader(path)) for path in args.stores]
+
+    image_ids = [image_id.decode() for image_id in readers[0][1].keys()]
+    random.seed(args.seed)
+    image_ids = random.sample(image_ids, min(args.num_images, len(image_ids)))
+
+    reference_size = store_size(args.lmdb_path)
+    print("************************************************")
+    for path, reader in readers:
+        # a first pass to take the page cache out of the comparison.
+        benchmark(reader, image_ids, args.batch_size)
+        single, batched = benchmark(reader, image_ids, args.batch_size)
+        size = store_size(path)
+        print("%s: %.1f MB (x%.2f) decoded %.1f MB/s, get_many %.1f MB/s" %(
+            os.path.basename(path.rstrip('/')), size / float(1 << 20), reference_size / float(size), single, batched))
+    print("************************************************")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import copy
+import logging
+import os
+import random
+import subprocess
+import time
+import tracemalloc
+import types
+
+import numpy as np
+import torch
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+from tensorpack.utils.serialize import loads
+
+from bertmodel.datasets.concept_cap_dataset import (
+    BatchMasker,
+    BertPreprocessBatch,
+    _open_serialized_lmdb,
+    fill_global_region,
+    topk_image_target,
+)
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+_DATASET_PATH = "bertmodel/datasets/concept_cap_dataset.py"
+
+# the calls that hand out a new array or tensor buffer.
+_ALLOCATORS = [
+    (np, "zeros"), (np, "full"), (np, "empty"), (np, "array"), (np, "stack"),
+    (np, "concatenate"), (np, "repeat"), (copy, "deepcopy"), (torch, "tensor"),
+]
+
+
+@contextlib.contextmanager
+def count_allocations(counts):
+    """Counts the calls of _ALLOCATORS (not the ones they make themselves) into counts[name]."""
+    originals = [(module, name, getattr(module, name)) for module, name in _ALLOCATORS]
+    depth = [0]
+
+    def wrap(name, function):
+        def counted(*args, **kwargs):
+            if depth[0] == 0:
+                counts[name] = counts.get(name, 0) + 1
+            depth[0] += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                depth[0] -= 1
+        return counted
+
+    for module, name, function in originals:
+        setattr(module, name, wrap(name, function))
+    try:
+        yield counts
+    finally:
+        for module, name, function in originals:
+            setattr(module, name, function)
+
+
+def load_baseline(ref):
+    """The concept_cap_dataset module of the commit `ref`, read from git without a checkout."""
+    source = subprocess.check_output(["git", "show", "%s:%s" % (ref, _DATASET_PATH)], cwd=_REPO_DIR)
+    module = types.ModuleType("baseline_concept_cap_dataset")
+    module.__file__ = "%s:%s" % (ref, _DATASET_PATH)
+    exec(compile(source, module.__file__, "exec"), module.__dict__)
+    return module
+
+
+def per_sample_batch(preprocess, records):
+    """
+    The collate path of the baseline loader: every record is preprocessed and
+    masked by itself, the samples are stacked and the global region prepended.
+    """
+    samples = [preprocess(record) for record in records]
+    batch = [np.stack(field) for field in zip(*samples)]
+    input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
+    image_loc, image_target, image_label, image_mask, multimodal_mask, image_id = batch
+
+    batch_size = input_ids.shape[0]
+    g_image_feat = np.sum(image_feat, axis=1) / np.sum(image_mask, axis=1, keepdims=True)
+    image_feat = np.concatenate([np.expand_dims(g_image_feat, axis=1), image_feat], axis=1)
+    image_feat = np.array(image_feat, dtype=np.float32)
+
+    g_image_loc = np.repeat(np.array([[0,0,1,1,1]], dtype=np.float32), batch_size, axis=0)
+    image_loc = np.concatenate([np.expand_dims(g_image_loc, axis=1), image_loc], axis=1)
+    image_loc = np.array(image_loc, dtype=np.float32)
+    g_image_mask = np.repeat(np.array([[1]]), batch_size, axis=0)
+    image_mask = np.concatenate([g_image_mask, image_mask], axis=1)
+    multimodal_mask = np.concatenate([g_image_mask, multimodal_mask], axis=1)
+
+    batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
+        image_loc, image_target, image_label, image_mask, multimodal_mask, image_id)
+    return tuple(torch.tensor(data) for data in batch)
+
+
+def buffer_batch(preprocess, records):
+    """The collate path of ConceptCapStream: the records are filled into the batch buffers and masked together."""
+    preprocess, masker = preprocess
+    batch = preprocess.new_batch(len(records))
+    for i, record in enumerate(records):
+        preprocess.fill(batch, i, record)
+    batch = masker(batch)
+    fill_global_region(batch)
+    return tuple(torch.from_numpy(data) for data in batch[:12])
+
+
+def benchmark(collate, preprocess, batches):
+    """ms per batch, allocator calls per batch and peak traced MB of one batch."""
+    random.seed(0)
+    start = time.perf_counter()
+    for records in batches:
+        collate(preprocess, records)
+    ms = (time.perf_counter() - start) * 1000.0 / len(batches)
+
+    counts = {}
+    with count_allocations(counts):
+        collate(preprocess, batches[0])
+
+    tracemalloc.start()
+    collate(preprocess, batches[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ms, counts, peak / float(1 << 20)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--data_dir",
+        required=True,
+        type=str,
+        help="The pretraining data dir with training_feat_all.lmdb and caption_train.json.",
+    )
+    parser.add_argument(
+        "--bert_model",
+        default="bert-base-uncased",
+        type=str,
+        help="Bert pre-trained model selected in the list: bert-base-uncased, "
+        "bert-large-uncased, bert-base-cased, bert-base-multilingual, bert-base-chinese.",
+    )
+    parser.add_argument(
+        "--do_lower_case",
+        type=bool,
+        default=True,
+        help="Whether to lower case the input text. True for uncased models, False for cased models.",
+    )
+    parser.add_argument("--batch_size", default=64, type=int, help="Records per batch.")
+    parser.add_argument("--num_batches", default=10, type=int, help="Number of batches to time.")
+    parser.add_argument(
+        "--image_target_topk", default=0, type=int, help="Top-k visual targets, 0 for the dense 1601 classes."
+    )
+    parser.add_argument(
+        "--baseline_ref",
+        default="5a895229dcc3f90fd6bef92c63045cf20bb42f9d",
+        type=str,
+        help="The git commit whose per-sample BertPreprocessBatch is timed against the batch buffers.",
+    )
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    caption_path = os.path.join(args.data_dir, "caption_train.json")
+    baseline = load_baseline(args.baseline_ref).BertPreprocessBatch(caption_path, tokenizer, 36, 36, 0)
+    preprocess = BertPreprocessBatch(
+        caption_path,
+        tokenizer,
+        36,
+        36,
+        0,
+        image_target_topk=args.image_target_topk,
+    )
+    masker = BatchMasker(tokenizer)
+
+    # the records are decoded up front, the benchmark leaves the lmdb reads out.
+    lmdb_file = os.path.join(args.data_dir, "training_feat_all.lmdb")
+    with _open_serialized_lmdb(lmdb_file).begin(write=False) as txn:
+        records = [
+            loads(txn.get(u"{:08}".format(i).encode("ascii")))
+            for i in range(args.batch_size * args.num_batches)
+        ]
+    batches = [records[i:i + args.batch_size] for i in range(0, len(records), args.batch_size)]
+
+    print("************************************************")
+    paths = (
+        ("per-sample (%s)" % args.baseline_ref[:7], per_sample_batch, baseline),
+        ("batch buffers", buffer_batch, (preprocess, masker)),
+    )
+    for name, collate, state in paths:
+        ms, counts, peak = benchmark(collate, state, batches)
+        print("%s: %.2f ms/batch, %d allocations/batch (%s), peak %.1f MB" % (
+            name, ms, sum(counts.values()), ", ".join("%s %d" % item for item in sorted(counts.items())), peak))
+    print("************************************************")
+
+
+if __name__ == "__main__":
+    main()
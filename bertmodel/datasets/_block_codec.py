@@ -0,0 +1,108 @@
+import numpy as np
+
+BLOCK_COMPRESSIONS = ("zstd", "lz4")
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Please install zstandard (pip install zstandard) to use zstd compressed feature stores.")
+    return zstandard
+
+
+def _import_lz4():
+    try:
+        import lz4.block
+    except ImportError:
+        raise ImportError("Please install lz4 (pip install lz4) to use lz4 compressed feature stores.")
+    return lz4.block
+
+
+def shuffle_bytes(array):
+    """
+    Groups the i-th byte of every element together. Exponent and high mantissa
+    bytes of float features repeat a lot, so the shuffled bytes compress much
+    better than the raw array.
+    """
+    array = np.ascontiguousarray(array)
+    return array.view(np.uint8).reshape(-1, array.dtype.itemsize).T.tobytes()
+
+
+def unshuffle_bytes(data, out):
+    """Inverse of `shuffle_bytes`, writes the elements into the preallocated `out`."""
+    itemsize = out.dtype.itemsize
+    shuffled = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1)
+    out.view(np.uint8).reshape(-1, itemsize)[...] = shuffled.T
+    return out
+
+
+def train_dictionary(samples, dict_size=112640):
+    """Trains a zstd dictionary on raw sample blocks, it is used by both codecs."""
+    zstandard = _import_zstd()
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
+class BlockCodec(object):
+    """
+    Compresses and decompresses independent blocks (one image each) with zstd
+    or lz4, optionally primed with a shared dictionary. The (de)compression
+    contexts are created once and reused for every block, they are not
+    thread safe.
+
+    Parameters
+    ----------
+    compression : str
+        "zstd" or "lz4".
+    level : int
+        Compression level, the zstd level or the lz4 high compression level
+        (0 for the default lz4 mode).
+    dictionary : bytes
+        Shared dictionary from `train_dictionary`, or None.
+    """
+    def __init__(self, compression, level=3, dictionary=None):
+        if compression not in BLOCK_COMPRESSIONS:
+            raise ValueError("unknown compression %s, expected one of %s" % (compression, ", ".join(BLOCK_COMPRESSIONS)))
+        self.compression = compression
+        self.level = level
+        self.dictionary = dictionary
+        self._compressor = None
+        self._decompressor = None
+
+    def _zstd_dict(self, zstandard):
+        if self.dictionary is None:
+            return None
+        return zstandard.ZstdCompressionDict(self.dictionary)
+
+    def compress(self, data):
+        if self.compression == "zstd":
+            if self._compressor is None:
+                zstandard = _import_zstd()
+                self._compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self._zstd_dict(zstandard))
+            return self._compressor.compress(data)
+
+        lz4_block = _import_lz4()
+        kwargs = {"store_size": False}
+        if self.level > 0:
+            kwargs.update(mode="high_compression", compression=self.level)
+        if self.dictionary is not None:
+            kwargs["dict"] = self.dictionary
+        return lz4_block.compress(data, **kwargs)
+
+    def decompress(self, data, raw_size):
+        if self.compression == "zstd":
+            if self._decompressor is None:
+                zstandard = _import_zstd()
+                self._decompressor = zstandard.ZstdDecompressor(dict_data=self._zstd_dict(zstandard))
+            return self._decompressor.decompress(data, max_output_size=raw_size)
+
+        lz4_block = _import_lz4()
+        if self.dictionary is not None:
+            return lz4_block.decompress(data, uncompressed_size=raw_size, dict=self.dictionary)
+        return lz4_block.decompress(data, uncompressed_size=raw_size)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_compressor"] = None
+        state["_decompressor"] = None
+        return state
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CAPTION_STORE_VERSION = 1
+_META_FILE = "meta.json"
+
+
+def is_caption_store(path):
+    """Whether `path` is a caption store written by `build_caption_store`."""
+    return os.path.isfile(os.path.join(path, _META_FILE))
+
+
+def vocab_checksum(tokenizer):
+    """md5 of the vocabulary, the token ids of a store are only valid for it."""
+    return hashlib.md5("\n".join(tokenizer.vocab.keys()).encode("utf-8")).hexdigest()
+
+
+def build_caption_store(caption_path, path, tokenizer):
+    """
+    Tokenizes the captions of a `caption_*.json` ({image_id: caption}) once and
+    writes them to `path`:
+
+        keys.npy     sorted image ids, [N] bytes
+        offsets.npy  [N + 1] int64, the tokens of keys[i] are tokens[offsets[i]:offsets[i + 1]]
+        tokens.npy   all the WordPiece ids concatenated, uint16 for BERT vocabularies
+    """
+    captions = json.load(open(caption_path, "r"))
+    keys = sorted(captions.keys())
+    token_ids = [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(captions[key])) for key in keys]
+
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ids) for ids in token_ids])
+    token_dtype = np.uint16 if len(tokenizer.vocab) <= np.iinfo(np.uint16).max + 1 else np.int32
+    tokens = np.fromiter((i for ids in token_ids for i in ids), dtype=token_dtype, count=int(offsets[-1]))
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, "keys.npy"), np.array([key.encode("utf-8") for key in keys]))
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "tokens.npy"), tokens)
+    # the meta file is written last, it marks the store as complete.
+    with open(os.path.join(path, _META_FILE), "w") as f:
+        json.dump({
+            "version": CAPTION_STORE_VERSION,
+            "num_captions": len(keys),
+            "num_tokens": int(offsets[-1]),
+            "vocab_size": len(tokenizer.vocab),
+            "vocab_md5": vocab_checksum(tokenizer),
+        }, f)
+    return len(keys)
+
+
+class CaptionStore(object):
+    """
+    Pre-tokenized captions of `build_caption_store`, looked up by image id or by
+    position. The arrays are memory-mapped, so DataLoader workers share the
+    page cache instead of each holding the caption json.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store.
+    tokenizer : BertTokenizer
+        If given, checked against the vocabulary the store was built with.
+    """
+    def __init__(self, path, tokenizer=None):
+        self.path = path
+        with open(os.path.join(path, _META_FILE), "r") as f:
+            self._meta = json.load(f)
+        if self._meta["version"] != CAPTION_STORE_VERSION:
+            raise ValueError("%s: unsupported caption store version %s" % (path, self._meta["version"]))
+        if tokenizer is not None and self._meta["vocab_md5"] != vocab_checksum(tokenizer):
+            raise ValueError("%s was built with a different vocabulary, rebuild it with build_captions.py" % path)
+        self._arrays = None
+
+    def _open(self):
+        self._arrays = [
+            np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+            for name in ("keys", "offsets", "tokens")
+        ]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self):
+        return self._meta["num_captions"]
+
+    def index(self, image_id):
+        """Position of `image_id` in the store, or -1."""
+        if self._arrays is None:
+            self._open()
+        keys = self._arrays[0]
+        key = image_id.encode("utf-8") if isinstance(image_id, str) else image_id
+        i = int(np.searchsorted(keys, key))
+        if i < len(keys) and keys[i] == key:
+            return i
+        return -1
+
+    def __contains__(self, image_id):
+        return self.index(image_id) >= 0
+
+    def key(self, i):
+        if self._arrays is None:
+            self._open()
+        return self._arrays[0][i].decode("utf-8")
+
+    def tokens(self, i):
+        """WordPiece ids of the caption at position `i`, as a list."""
+        if self._arrays is None:
+            self._open()
+        _, offsets, tokens = self._arrays
+        return tokens[offsets[i]:offsets[i + 1]].tolist()
+
+    def __getitem__(self, image_id):
+        i = self.index(image_id)
+        if i < 0:
+            raise KeyError(image_id)
+        return self.tokens(i)
@@ -0,0 +1,624 @@
+from typing import List
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import torch.distributed as dist
+
+from ._block_codec import BlockCodec, BLOCK_COMPRESSIONS, shuffle_bytes, unshuffle_bytes
+from ._telemetry import ReaderStats
+
+# version 2 added the compressed feature blocks, stores of version 1 read the same.
+FEATURE_STORE_VERSION = 2
+_META_FILE = "meta.json"
+_INDEX_FILE = "index.npz"
+_FEATURES_FILE = "features.bin"
+_BOXES_FILE = "boxes.bin"
+_BOXES_ORI_FILE = "boxes_ori.bin"
+_SCALES_FILE = "scales.bin"
+_DICTIONARY_FILE = "dictionary.bin"
+
+# encodings of the region features. int8 features are stored with one scale
+# per region (row), x ~= q * scale with scale = max(|x|) / 127.
+FEATURE_DTYPES = ("float32", "float16", "int8")
+
+
+def is_feature_store(path):
+    """Whether `path` is a memory-mapped feature store written by FeatureStoreWriter."""
+    return os.path.isfile(os.path.join(path, _META_FILE))
+
+
+def _will_need(path, offset, length):
+    """Asks the kernel to read a byte range of `path` into the page cache in the background."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    # the read goes on once the descriptor is closed, none is kept open.
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def _open_data_file(path, size=None):
+    if size is None:
+        return open(path, "wb")
+    # appending: drop whatever an interrupted append wrote past the indexed data.
+    f = open(path, "r+b")
+    f.truncate(size)
+    f.seek(size)
+    return f
+
+
+def encode_features(features, dtype):
+    """
+    Stored rows of `features` in the encoding `dtype`, and the per-region
+    scales for int8 (None otherwise).
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.int8:
+        features = np.asarray(features, dtype=np.float32)
+        scales = np.abs(features).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.rint(features / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return np.ascontiguousarray(features, dtype=dtype), None
+
+
+def raw_feature_block(features, dtype, shuffle=True):
+    """Uncompressed block of one image, e.g. as a dictionary training sample."""
+    stored, _ = encode_features(features, dtype)
+    return shuffle_bytes(stored) if shuffle else stored.tobytes()
+
+
+class FeatureStoreWriter(object):
+    """
+    Writes region features in the memory-mapped feature store layout.
+
+    All images are concatenated row-wise into three flat files, so the rows of
+    one image are contiguous and can be handed out as views without a decode
+    step. The rows are stored exactly as `ImageFeaturesH5Reader` returns them,
+    i.e. with the mean "global" region prepended.
+
+    Example of a feature store:
+    ```
+    flickr30k_resnet101_faster_rcnn_genome.mmap
+       |--- meta.json       ({"version", "feature_size", "dtype", "num_rows", "compression", ...})
+       |--- index.npz       ("keys", "offsets", "num_boxes"[, "block_offsets"]) one entry per image
+       |--- features.bin    [num_rows, feature_size] in `dtype`, or one compressed block per image
+       |--- dictionary.bin  shared dictionary of the compressed blocks, optional
+       |--- scales.bin      [num_rows] float32, only for int8 features
+       |--- boxes.bin       [num_rows, 5] normalized (x1, y1, x2, y2, area)
+       +--- boxes_ori.bin   [num_rows, 5] in pixels
+    ```
+
+    The boxes are always float32, only the features are quantized or
+    compressed.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the feature store.
+    feature_size : int
+        Dimension of the region features.
+    append : bool
+        Add images to an existing store instead of creating a new one.
+    dtype : str
+        Encoding of the features, one of "float32", "float16" or "int8". When
+        appending, the encoding of the existing store is kept.
+    compression : str
+        None, or "zstd" / "lz4" to losslessly compress the features of every
+        image as an independent block.
+    level : int
+        Compression level, see `BlockCodec`.
+    dictionary : bytes
+        Dictionary shared by all the blocks, see `_block_codec.train_dictionary`.
+    shuffle : bool
+        Byte-shuffle the features before compressing them.
+    """
+    def __init__(self, path: str, feature_size: int = 2048, append: bool = False, dtype: str = "float32",
+                 compression: str = None, level: int = 3, dictionary: bytes = None, shuffle: bool = True):
+        if dtype not in FEATURE_DTYPES:
+            raise ValueError("unknown feature dtype %s, expected one of %s" % (dtype, ", ".join(FEATURE_DTYPES)))
+        if compression is not None and compression not in BLOCK_COMPRESSIONS:
+            raise ValueError("unknown compression %s, expected one of %s" % (compression, ", ".join(BLOCK_COMPRESSIONS)))
+        self.path = path
+        self.feature_size = feature_size
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.level = level
+        self.dictionary = dictionary
+        self.shuffle = shuffle
+
+        self._keys = []
+        self._offsets = []
+        self._num_boxes = []
+        self._num_rows = 0
+        self._block_offsets = [0]
+
+        sizes = {}
+        if append and is_feature_store(path):
+            with open(os.path.join(path, _META_FILE), "r") as f:
+                meta = json.load(f)
+            self.feature_size = meta["feature_size"]
+            self.dtype = np.dtype(meta["dtype"])
+            self.compression = meta.get("compression")
+            self.level = meta.get("level", level)
+            self.shuffle = meta.get("shuffle", shuffle)
+            self._num_rows = meta["num_rows"]
+            index = np.load(os.path.join(path, _INDEX_FILE))
+            self._keys = list(index["keys"])
+            self._offsets = index["offsets"].tolist()
+            self._num_boxes = index["num_boxes"].tolist()
+
+            self.dictionary = None
+            if self.compression is not None:
+                self._block_offsets = index["block_offsets"].tolist()
+                if os.path.isfile(os.path.join(path, _DICTIONARY_FILE)):
+                    with open(os.path.join(path, _DICTIONARY_FILE), "rb") as f:
+                        self.dictionary = f.read()
+                sizes[_FEATURES_FILE] = self._block_offsets[-1]
+            else:
+                sizes[_FEATURES_FILE] = self._num_rows * self.feature_size * self.dtype.itemsize
+            sizes[_BOXES_FILE] = sizes[_BOXES_ORI_FILE] = self._num_rows * 5 * 4
+            sizes[_SCALES_FILE] = self._num_rows * 4
+        else:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            if self.compression is not None and self.dictionary is not None:
+                with open(os.path.join(path, _DICTIONARY_FILE), "wb") as f:
+                    f.write(self.dictionary)
+
+        self._codec = None
+        if self.compression is not None:
+            self._codec = BlockCodec(self.compression, self.level, self.dictionary)
+
+        self._key_set = set(self._keys)
+        self._features_f = _open_data_file(os.path.join(path, _FEATURES_FILE), sizes.get(_FEATURES_FILE))
+        self._boxes_f = _open_data_file(os.path.join(path, _BOXES_FILE), sizes.get(_BOXES_FILE))
+        self._boxes_ori_f = _open_data_file(os.path.join(path, _BOXES_ORI_FILE), sizes.get(_BOXES_ORI_FILE))
+        self._scales_f = None
+        if self.dtype == np.int8:
+            self._scales_f = _open_data_file(os.path.join(path, _SCALES_FILE), sizes.get(_SCALES_FILE))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, image_id):
+        return str(image_id).encode() in self._key_set
+
+    def add(self, image_id, features, image_location, image_location_ori):
+        key = str(image_id).encode()
+        if key in self._key_set:
+            raise ValueError("image %s is already in the feature store" % image_id)
+
+        num_boxes = features.shape[0]
+        assert features.shape[1] == self.feature_size
+        assert image_location.shape == (num_boxes, 5)
+        assert image_location_ori.shape == (num_boxes, 5)
+
+        stored, scales = encode_features(features, self.dtype)
+        if scales is not None:
+            self._scales_f.write(scales.tobytes())
+
+        if self._codec is not None:
+            block = self._codec.compress(shuffle_bytes(stored) if self.shuffle else stored.tobytes())
+            self._features_f.write(block)
+            self._block_offsets.append(self._block_offsets[-1] + len(block))
+        else:
+            self._features_f.write(stored.tobytes())
+        self._boxes_f.write(np.ascontiguousarray(image_location, dtype=np.float32).tobytes())
+        self._boxes_ori_f.write(np.ascontiguousarray(image_location_ori, dtype=np.float32).tobytes())
+
+        self._keys.append(key)
+        self._key_set.add(key)
+        self._offsets.append(self._num_rows)
+        self._num_boxes.append(num_boxes)
+        self._num_rows += num_boxes
+
+    def close(self):
+        for f in (self._features_f, self._boxes_f, self._boxes_ori_f, self._scales_f):
+            if f is not None:
+                f.close()
+
+        # the index and meta are written last (and atomically) so that an
+        # interrupted append leaves the previous store readable.
+        index = dict(
+            keys=np.array(self._keys, dtype=np.bytes_),
+            offsets=np.array(self._offsets, dtype=np.int64),
+            num_boxes=np.array(self._num_boxes, dtype=np.int32),
+        )
+        if self.compression is not None:
+            index["block_offsets"] = np.array(self._block_offsets, dtype=np.int64)
+        index_tmp = os.path.join(self.path, "index.tmp.npz")
+        np.savez(index_tmp, **index)
+        os.replace(index_tmp, os.path.join(self.path, _INDEX_FILE))
+
+        meta = {
+            "version": FEATURE_STORE_VERSION,
+            "feature_size": self.feature_size,
+            "dtype": self.dtype.name,
+            "num_rows": self._num_rows,
+            "compression": self.compression,
+            "level": self.level,
+            "shuffle": self.shuffle,
+        }
+        meta_tmp = os.path.join(self.path, _META_FILE + ".tmp")
+        with open(meta_tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_tmp, os.path.join(self.path, _META_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ImageFeaturesMmapReader(object):
+    """
+    A reader for feature stores written by `FeatureStoreWriter`. It has the same
+    contract as `ImageFeaturesH5Reader`, but `__getitem__` only looks up the
+    offset of the image and returns read-only views into the memory-mapped
+    files, there is no unpickling or base64 decoding.
+
+    float16 and int8 stores are dequantized on read. With `dequantize=False`
+    the features of such stores are handed out as float16 instead, to keep the
+    DataLoader batches small, and are expected to be cast to float32 once the
+    batch has been collated (see `task_utils.ForwardModelsTrain`).
+
+    The blocks of compressed stores are decompressed on read, `get_many`
+    decompresses into a buffer that is reused across calls.
+
+    Parameters
+    ----------
+    features_path : str
+        Path to the feature store directory.
+    in_memory : bool
+        Whether to load the whole store in memory instead of reading it through
+        the page cache.
+    dequantize : bool
+        Whether float16 and int8 features are returned as float32.
+    """
+    def __init__(self, features_path: str, in_memory: bool = False, dequantize: bool = True):
+        self.features_path = features_path
+        self._in_memory = in_memory
+
+        with open(os.path.join(features_path, _META_FILE), "r") as f:
+            self._meta = json.load(f)
+        assert self._meta["version"] <= FEATURE_STORE_VERSION
+        self._feature_size = self._meta["feature_size"]
+
+        index = np.load(os.path.join(features_path, _INDEX_FILE))
+        self._image_ids = list(index["keys"])
+        self._offsets = index["offsets"]
+        self._num_boxes = index["num_boxes"]
+        self._key2index = {key: i for i, key in enumerate(self._image_ids)}
+
+        self._store_dtype = np.dtype(self._meta["dtype"])
+        if dequantize or self._store_dtype == np.float32:
+            self.feature_dtype = np.dtype(np.float32)
+        else:
+            self.feature_dtype = np.dtype(np.float16)
+
+        self._codec = None
+        self._block_offsets = None
+        if self._meta.get("compression") is not None:
+            self._block_offsets = index["block_offsets"]
+            dictionary = None
+            if os.path.isfile(os.path.join(features_path, _DICTIONARY_FILE)):
+                with open(os.path.join(features_path, _DICTIONARY_FILE), "rb") as f:
+                    dictionary = f.read()
+            self._codec = BlockCodec(self._meta["compression"], self._meta["level"], dictionary)
+
+        self.features = None
+        self.scales = None
+        self.boxes = None
+        self.boxes_ori = None
+        self._buffer = None
+        self.stats = ReaderStats()
+
+        # bytes of one region (row) in the box (and scale) files.
+        self._box_row_bytes = 2 * 5 * 4
+        if self._store_dtype == np.int8:
+            self._box_row_bytes += 4
+
+    def _open(self):
+        num_rows = self._meta["num_rows"]
+        if self._codec is not None:
+            self.features = self._map(_FEATURES_FILE, np.uint8, (int(self._block_offsets[-1]),))
+        else:
+            self.features = self._map(_FEATURES_FILE, self._store_dtype, (num_rows, self._feature_size))
+        self.boxes = self._map(_BOXES_FILE, np.float32, (num_rows, 5))
+        self.boxes_ori = self._map(_BOXES_ORI_FILE, np.float32, (num_rows, 5))
+        if self._store_dtype == np.int8:
+            self.scales = self._map(_SCALES_FILE, np.float32, (num_rows,))
+
+    def _map(self, name, dtype, shape):
+        path = os.path.join(self.features_path, name)
+        if self._in_memory:
+            array = np.fromfile(path, dtype=dtype).reshape(shape)
+            array.setflags(write=False)
+            return array
+        return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+    def __getstate__(self):
+        # the mappings are re-created in the process that unpickles the reader.
+        state = self.__dict__.copy()
+        state["features"] = state["scales"] = state["boxes"] = state["boxes_ori"] = None
+        state["_buffer"] = None
+        return state
+
+    def _dequantize(self, features, rows):
+        # `rows` is a slice or an index array into the store, for the int8 scales.
+        if self._store_dtype == np.int8:
+            scales = self.scales[rows].astype(self.feature_dtype)
+            return features.astype(self.feature_dtype) * scales[:, None]
+        if features.dtype != self.feature_dtype:
+            return features.astype(self.feature_dtype)
+        return features
+
+    def _decode_buffer(self):
+        """Buffer of the rows of the largest image, the decompressed rows go there before they are copied."""
+        if self._buffer is None:
+            self._buffer = np.empty((int(self._num_boxes.max()), self._feature_size), dtype=self._store_dtype)
+        return self._buffer
+
+    def _decompress(self, index, out):
+        """Decompresses the stored feature rows of image `index` into `out`."""
+        block = self.features[self._block_offsets[index]:self._block_offsets[index + 1]]
+        data = self._codec.decompress(block, out.nbytes)
+        if self._meta["shuffle"]:
+            return unshuffle_bytes(data, out)
+        out[...] = np.frombuffer(data, dtype=out.dtype).reshape(out.shape)
+        return out
+
+    def _stored_bytes(self, indices, num_boxes):
+        """Bytes of the stored rows of the images `indices`."""
+        if self._codec is None:
+            feature_bytes = np.sum(num_boxes) * self._feature_size * self._store_dtype.itemsize
+        else:
+            feature_bytes = np.sum(self._block_offsets[indices + 1] - self._block_offsets[indices])
+        return int(feature_bytes + np.sum(num_boxes) * self._box_row_bytes)
+
+    def __len__(self):
+        return len(self._image_ids)
+
+    def __getitem__(self, image_id):
+        if self.features is None:
+            self._open()
+
+        index = self._key2index[str(image_id).encode()]
+        start = int(self._offsets[index])
+        num_boxes = int(self._num_boxes[index])
+        end = start + num_boxes
+
+        decode_start = time.perf_counter()
+        if self._codec is None:
+            features = self._dequantize(self.features[start:end], slice(start, end))
+        else:
+            stored = self._decompress(index, self._decode_buffer()[:num_boxes])
+            features = self._dequantize(stored, slice(start, end))
+            if features is stored:
+                # the buffer is overwritten by the next read.
+                features = features.copy()
+        self.stats.add(
+            reads=1,
+            bytes=self._stored_bytes(np.array([index]), num_boxes),
+            decode_us=(time.perf_counter() - decode_start) * 1e6,
+        )
+
+        return features, num_boxes, self.boxes[start:end], self.boxes_ori[start:end]
+
+    def prefetch(self, image_id):
+        """Asks the kernel to read the rows of an image ahead of `__getitem__`."""
+        if self._in_memory:
+            return
+        index = self._key2index[str(image_id).encode()]
+        start = int(self._offsets[index])
+        num_boxes = int(self._num_boxes[index])
+
+        files = [(_BOXES_FILE, 5 * 4), (_BOXES_ORI_FILE, 5 * 4)]
+        if self._store_dtype == np.int8:
+            files.append((_SCALES_FILE, 4))
+        if self._codec is None:
+            files.append((_FEATURES_FILE, self._feature_size * self._store_dtype.itemsize))
+        else:
+            block_start = int(self._block_offsets[index])
+            _will_need(os.path.join(self.features_path, _FEATURES_FILE),
+                       block_start, int(self._block_offsets[index + 1]) - block_start)
+        for name, row_bytes in files:
+            _will_need(os.path.join(self.features_path, name), start * row_bytes, num_boxes * row_bytes)
+
+    def get_many(self, image_ids, max_boxes=None):
+        """
+        Reads several images at once into padded batch arrays, see
+        `ImageFeaturesH5Reader.get_many`.
+        """
+        if self.features is None:
+            self._open()
+
+        indices = np.array([self._key2index[str(image_id).encode()] for image_id in image_ids], dtype=np.int64)
+        offsets = self._offsets[indices]
+        num_boxes = self._num_boxes[indices].astype(np.int64)
+        if max_boxes is None:
+            max_boxes = int(num_boxes.max())
+        num_boxes = np.minimum(num_boxes, max_boxes)
+
+        # one gather for all the rows of the batch.
+        valid = np.arange(max_boxes)[None, :] < num_boxes[:, None]
+        rows = (offsets[:, None] + np.arange(max_boxes)[None, :])[valid]
+
+        batch_size = len(indices)
+        features = np.zeros((batch_size, max_boxes, self._feature_size), dtype=self.feature_dtype)
+        image_location = np.zeros((batch_size, max_boxes, 5), dtype=np.float32)
+        image_location_ori = np.zeros((batch_size, max_boxes, 5), dtype=np.float32)
+        start = time.perf_counter()
+        if self._codec is None:
+            features[valid] = self._dequantize(self.features[rows], rows)
+        else:
+            buffer = self._decode_buffer()
+            for i, index in enumerate(indices):
+                n = num_boxes[i]
+                stored = self._decompress(index, buffer[:int(self._num_boxes[index])])
+                features[i, :n] = self._dequantize(stored[:n], slice(offsets[i], offsets[i] + n))
+        image_location[valid] = self.boxes[rows]
+        image_location_ori[valid] = self.boxes_ori[rows]
+        self.stats.add(
+            reads=batch_size,
+            bytes=self._stored_bytes(indices, num_boxes),
+            decode_us=(time.perf_counter() - start) * 1e6,
+        )
+
+        return features, num_boxes, image_location, image_location_ori
+
+    def keys(self) -> List[bytes]:
+        return self._image_ids
+
+
+def build_padded_region_store(path, image_ids, load_regions, max_region_num, feature_size=2048):
+    """
+    Precomputes the padded region inputs of a dataset for every image, so that
+    `__getitem__` only has to slice them.
+
+    `load_regions(image_id)` returns the padded `(features, spatials,
+    image_mask, num_boxes)` of one image, with shapes [max_region_num,
+    feature_size], [max_region_num, 5] and [max_region_num]. The features are
+    stored in the dtype `load_regions` returns them in. The store is written to
+    a temporary directory of the process first so that an interrupted build is
+    never picked up as a complete cache.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    num_images = len(image_ids)
+    feature_dtype = load_regions(image_ids[0])[0].dtype if num_images else np.float32
+    features_all = np.lib.format.open_memmap(
+        os.path.join(tmp_path, "features.npy"), mode="w+", dtype=feature_dtype, shape=(num_images, max_region_num, feature_size))
+    spatials_all = np.lib.format.open_memmap(
+        os.path.join(tmp_path, "spatials.npy"), mode="w+", dtype=np.float32, shape=(num_images, max_region_num, 5))
+    image_mask_all = np.lib.format.open_memmap(
+        os.path.join(tmp_path, "image_mask.npy"), mode="w+", dtype=np.int64, shape=(num_images, max_region_num))
+    num_boxes_all = np.zeros(num_images, dtype=np.int64)
+
+    for i, image_id in enumerate(image_ids):
+        features, spatials, image_mask, num_boxes = load_regions(image_id)
+        features_all[i] = features
+        spatials_all[i] = spatials
+        image_mask_all[i] = image_mask
+        num_boxes_all[i] = num_boxes
+
+    features_all.flush()
+    spatials_all.flush()
+    image_mask_all.flush()
+    del features_all, spatials_all, image_mask_all
+    np.save(os.path.join(tmp_path, "num_boxes.npy"), num_boxes_all)
+    np.save(os.path.join(tmp_path, "keys.npy"), np.array([str(image_id).encode() for image_id in image_ids], dtype=np.bytes_))
+
+    if os.path.exists(path):
+        # built by another job meanwhile.
+        shutil.rmtree(tmp_path)
+        return
+    os.rename(tmp_path, path)
+
+
+def padded_region_store_path(prefix, readers):
+    """
+    Path of a padded region store built from `readers`: `prefix` followed by a
+    digest of the path and feature dtype of every reader, so that stores of
+    other features are never mixed up.
+    """
+    sources = [
+        "%s:%s" % (os.path.abspath(reader.features_path), np.dtype(getattr(reader, "feature_dtype", np.float32)).name)
+        for reader in readers
+    ]
+    return "%s_%s_regions" % (prefix, hashlib.md5("\n".join(sources).encode("utf-8")).hexdigest()[:12])
+
+
+def open_padded_region_store(path, image_ids, load_regions, max_region_num, stats=None):
+    """
+    The `PaddedRegionStore` at `path` counting its reads in `stats`, built with
+    `build_padded_region_store` if missing. Under torch.distributed rank 0
+    builds it while the other ranks wait at a barrier.
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    if not os.path.exists(path) and (not distributed or dist.get_rank() == 0):
+        print('precomputing padded regions to %s' %(path))
+        build_padded_region_store(path, image_ids, load_regions, max_region_num)
+    if distributed:
+        dist.barrier()
+    return PaddedRegionStore(path, stats=stats)
+
+
+class PaddedRegionStore(object):
+    """
+    Reads a store written by `build_padded_region_store`. Indexing with an
+    image id returns read-only views of its padded `(features, spatials,
+    image_mask, num_boxes)`.
+
+    The reads are counted in `stats`, e.g. those of the feature reader the
+    store was built from, by default in a `ReaderStats` of its own.
+    """
+    def __init__(self, path: str, stats: ReaderStats = None):
+        self.path = path
+        keys = np.load(os.path.join(path, "keys.npy"))
+        self._key2index = {key: i for i, key in enumerate(keys)}
+        self._num_boxes = np.load(os.path.join(path, "num_boxes.npy"))
+        self._arrays = None
+        self._row_bytes = 0
+        self.stats = ReaderStats() if stats is None else stats
+
+    def _open(self):
+        self._arrays = [
+            np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+            for name in ("features", "spatials", "image_mask")
+        ]
+        # bytes of the padded inputs of one image.
+        self._row_bytes = sum(array[0].nbytes for array in self._arrays)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __len__(self):
+        return len(self._key2index)
+
+    def __contains__(self, image_id):
+        return str(image_id).encode() in self._key2index
+
+    def __getitem__(self, image_id):
+        if self._arrays is None:
+            self._open()
+        index = self._key2index[str(image_id).encode()]
+        features, spatials, image_mask = self._arrays
+        self.stats.add(reads=1, bytes=self._row_bytes)
+        return features[index], spatials[index], image_mask[index], int(self._num_boxes[index])
+
+    def prefetch(self, image_id):
+        """Asks the kernel to read the padded inputs of an image ahead of `__getitem__`."""
+        if self._arrays is None:
+            self._open()
+        index = self._key2index[str(image_id).encode()]
+        for array in self._arrays:
+            row_bytes = array[0].nbytes
+            _will_need(array.filename, array.offset + index * row_bytes, row_bytes)
+
+    def get_many(self, image_ids):
+        """Gathers several images at once, the returned arrays are new (writable) batches."""
+        if self._arrays is None:
+            self._open()
+        indices = np.array([self._key2index[str(image_id).encode()] for image_id in image_ids], dtype=np.int64)
+        features, spatials, image_mask = self._arrays
+        start = time.perf_counter()
+        batch = features[indices], spatials[indices], image_mask[indices], self._num_boxes[indices]
+        self.stats.add(
+            reads=len(indices),
+            bytes=len(indices) * self._row_bytes,
+            decode_us=(time.perf_counter() - start) * 1e6,
+        )
+        return batch
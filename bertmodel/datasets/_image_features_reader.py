@@ -3,11 +3,34 @@ import csv
 import h5py
 import numpy as np
 import copy
+import os
 import pickle
 import lmdb 
 import base64
+import threading
+import time
 import pdb
 
+from ._shared_cache import SharedArrayCache
+from ._telemetry import ReaderStats
+
+# lmdb envs opened by this process, keyed by (pid, path). an env can only be
+# opened once per process and must not be used across a fork. the prefetch
+# threads open envs too, so the lookup and the opening hold the lock.
+_lmdb_envs = {}
+_lmdb_envs_lock = threading.Lock()
+
+def _open_lmdb_env(path, subdir=True, readahead=False):
+    key = (os.getpid(), path)
+    with _lmdb_envs_lock:
+        if key not in _lmdb_envs:
+            # drop the handle inherited from the parent process before reopening.
+            for stale_key in [k for k in _lmdb_envs if k[1] == path]:
+                _lmdb_envs.pop(stale_key).close()
+            _lmdb_envs[key] = lmdb.open(path, subdir=subdir, max_readers=126, readonly=True,
+                                        lock=False, readahead=readahead, meminit=False)
+        return _lmdb_envs[key]
+
 class ImageFeaturesH5Reader(object):
     """
     A reader for H5 files containing pre-extracted image features. A typical
@@ -28,106 +51,230 @@ class ImageFeaturesH5Reader(object):
     features_h5path : str
         Path to an H5 file containing COCO train / val image features.
     in_memory : bool
-        Whether to load the whole H5 file in memory. Beware, these files are
+        Whether to keep the decoded features in memory. Beware, these files are
         sometimes tens of GBs in size. Set this to true if you have sufficient
-        RAM - trade-off between speed and memory.
+        RAM - trade-off between speed and memory. The cache is shared by all
+        the DataLoader workers forked from the process that built the reader.
+    cache_bytes : int
+        Memory budget of the in-memory cache, least recently used images are
+        evicted beyond it. None for a quarter of the physical memory.
+    max_boxes : int
+        Images with more boxes (including the global one) are not cached.
     """
-    def __init__(self, features_path: str, in_memory: bool = False):
+    def __init__(self, features_path: str, in_memory: bool = False, cache_bytes: int = None, max_boxes: int = 101):
         self.features_path = features_path
         self._in_memory = in_memory
 
-        self.env = lmdb.open(self.features_path, max_readers=1, readonly=True,
-                            lock=False, readahead=False, meminit=False)
-
-        with self.env.begin(write=False) as txn: 
+        with _open_lmdb_env(self.features_path).begin(write=False) as txn: 
             self._image_ids = pickle.loads(txn.get('keys'.encode()))
 
-        self.features = [None] * len(self._image_ids)
-        self.num_boxes = [None] * len(self._image_ids)
-        self.boxes = [None] * len(self._image_ids)
-        self.boxes_ori = [None] * len(self._image_ids)
-    
+        # hashed index, `list.index` is a linear scan over all the keys.
+        self._key2index = {key: i for i, key in enumerate(self._image_ids)}
+
+        # the read transaction is opened lazily, and kept, in every process
+        # that reads (e.g. each forked DataLoader worker).
+        self.env = None
+        self._txn = None
+        self._pid = None
+
+        # reads, bytes, decode time and cache hits of every DataLoader worker.
+        self.stats = ReaderStats()
+
+        self._cache = None
+        if self._in_memory:
+            self._cache = SharedArrayCache(
+                [("features", (2048,), np.float32), ("boxes", (5,), np.float32), ("boxes_ori", (5,), np.float32)],
+                max_rows=max_boxes,
+                num_keys=len(self._image_ids),
+                capacity_bytes=cache_bytes,
+            )
+
+    def _get_txn(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # fresh process, never reuse the parent's handles.
+            self.env = _open_lmdb_env(self.features_path)
+            self._txn = self.env.begin(write=False, buffers=True)
+            self._pid = pid
+        return self._txn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["env"] = None
+        state["_txn"] = None
+        state["_pid"] = None
+        return state
+
     def __len__(self):
         return len(self._image_ids)
 
+    def _read(self, image_id):
+        data = self._get_txn().get(image_id)
+        start = time.perf_counter()
+        decoded = self.decode(pickle.loads(data))
+        self.stats.add(reads=1, bytes=len(data), decode_us=(time.perf_counter() - start) * 1e6)
+        return decoded
+
+    @staticmethod
+    def decode(item):
+        """Reader arrays of an unpickled lmdb record, with the global region prepended."""
+        image_h = int(item['image_h'])
+        image_w = int(item['image_w'])
+        num_boxes = int(item['num_boxes'])
+
+        features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
+        boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
+
+        g_feat = np.sum(features, axis=0) / num_boxes
+        num_boxes = num_boxes + 1
+        features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
+
+        image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
+        image_location[:,:4] = boxes
+        image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
+
+        image_location_ori = copy.deepcopy(image_location)
+
+        image_location[:,0] = image_location[:,0] / float(image_w)
+        image_location[:,1] = image_location[:,1] / float(image_h)
+        image_location[:,2] = image_location[:,2] / float(image_w)
+        image_location[:,3] = image_location[:,3] / float(image_h)
+
+        g_location = np.array([0,0,1,1,1])
+        image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
+
+        g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
+        image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
+
+        return features, num_boxes, image_location, image_location_ori
+
     def __getitem__(self, image_id):
         image_id = str(image_id).encode()
-        index = self._image_ids.index(image_id)
+        index = self._key2index[image_id]
         if self._in_memory:
             # Load features during first epoch, all not loaded together as it
             # has a slow start.
-            if self.features[index] is not None:
-                features = self.features[index]
-                num_boxes = self.num_boxes[index]
-                image_location = self.boxes[index]
-                image_location_ori = self.boxes_ori[index]
+            cached = self._cache.get(index)
+            if cached is not None:
+                self.stats.add(cache_hits=1)
+                features, image_location, image_location_ori = cached
+                num_boxes = features.shape[0]
             else:
-                with self.env.begin(write=False) as txn:
-                    item = pickle.loads(txn.get(image_id))
-                    image_id = item['image_id']
-                    image_h = int(item['image_h'])
-                    image_w = int(item['image_w'])
-                    num_boxes = int(item['num_boxes'])
-
-                    features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                    boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-                    
-                    g_feat = np.sum(features, axis=0) / num_boxes
-                    num_boxes = num_boxes + 1
-
-                    features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                    self.features[index] = features
-
-                    image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                    image_location[:,:4] = boxes
-                    image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                    image_location_ori = copy.deepcopy(image_location)
-
-                    image_location[:,0] = image_location[:,0] / float(image_w)
-                    image_location[:,1] = image_location[:,1] / float(image_h)
-                    image_location[:,2] = image_location[:,2] / float(image_w)
-                    image_location[:,3] = image_location[:,3] / float(image_h)
-
-                    g_location = np.array([0,0,1,1,1])
-                    image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-                    self.boxes[index] = image_location
-
-                    g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                    image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
-                    self.boxes_ori[index] = image_location_ori
-                    self.num_boxes[index] = num_boxes               
+                self.stats.add(cache_misses=1)
+                features, num_boxes, image_location, image_location_ori = self._read(image_id)
+                self._cache.put(index, [features, image_location, image_location_ori])
         else:
             # Read chunk from file everytime if not loaded in memory.    
-            with self.env.begin(write=False) as txn:
-                item = pickle.loads(txn.get(image_id))
-                image_id = item['image_id']
-                image_h = int(item['image_h'])
-                image_w = int(item['image_w'])
-                num_boxes = int(item['num_boxes'])
-
-                features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-                g_feat = np.sum(features, axis=0) / num_boxes
-                num_boxes = num_boxes + 1
-                features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                
-                image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                image_location[:,:4] = boxes
-                image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                image_location_ori = copy.deepcopy(image_location)
-                image_location[:,0] = image_location[:,0] / float(image_w)
-                image_location[:,1] = image_location[:,1] / float(image_h)
-                image_location[:,2] = image_location[:,2] / float(image_w)
-                image_location[:,3] = image_location[:,3] / float(image_h)
-
-                g_location = np.array([0,0,1,1,1])
-                image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-
-                g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
+            features, num_boxes, image_location, image_location_ori = self._read(image_id)
+
+        return features, num_boxes, image_location, image_location_ori
+
+    def prefetch(self, image_id):
+        """
+        Warms an image ahead of `__getitem__`, this can be called from a
+        background thread. With `in_memory` the image is decoded into the
+        shared cache, otherwise its record is read to pull it into the page
+        cache.
+        """
+        image_id = str(image_id).encode()
+        index = self._key2index[image_id]
+        if self._in_memory and index in self._cache:
+            return
+
+        # read transactions can't be shared between threads, so this one is
+        # not the cached `_txn`.
+        with _open_lmdb_env(self.features_path).begin(write=False) as txn:
+            data = txn.get(image_id)
+        if not self._in_memory:
+            # the record is read again by `__getitem__`, count it apart.
+            self.stats.add(prefetch_reads=1, prefetch_bytes=len(data))
+            return
+        start = time.perf_counter()
+        features, num_boxes, image_location, image_location_ori = self.decode(pickle.loads(data))
+        self._cache.put(index, [features, image_location, image_location_ori])
+        self.stats.add(reads=1, bytes=len(data), decode_us=(time.perf_counter() - start) * 1e6)
+
+    def get_many(self, image_ids, max_boxes=None):
+        """
+        Reads several images at once. Returns the padded batch arrays
+        `(features, num_boxes, image_location, image_location_ori)` of shapes
+        [num_images, max_boxes, 2048], [num_images], [num_images, max_boxes, 5]
+        and [num_images, max_boxes, 5]. Images with more boxes are truncated to
+        `max_boxes`, which defaults to the largest image of the batch.
+        """
+        keys = [str(image_id).encode() for image_id in image_ids]
+        indices = [self._key2index[key] for key in keys]
+
+        # cached images are copied, all the others are resolved in the same
+        # read transaction and decoded straight into the batch arrays.
+        entries = [None] * len(keys)
+        if self._in_memory:
+            entries = [self._cache.get(index) for index in indices]
+        txn = self._get_txn()
+        records = [txn.get(key) if entry is None else None for key, entry in zip(keys, entries)]
+        start = time.perf_counter()
+        items = [pickle.loads(record) if record is not None else None for record in records]
+
+        num_boxes = np.array([
+            entry[0].shape[0] if entry is not None else int(item['num_boxes']) + 1
+            for entry, item in zip(entries, items)
+        ], dtype=np.int64)
+        if max_boxes is None:
+            max_boxes = int(num_boxes.max())
+        truncated = num_boxes > max_boxes
+        num_boxes = np.minimum(num_boxes, max_boxes)
+
+        batch_size = len(keys)
+        features = np.zeros((batch_size, max_boxes, 2048), dtype=np.float32)
+        image_location = np.zeros((batch_size, max_boxes, 5), dtype=np.float32)
+        image_location_ori = np.zeros((batch_size, max_boxes, 5), dtype=np.float32)
+        image_size = np.ones((batch_size, 2), dtype=np.float32)
+        decoded = np.zeros(batch_size, dtype=bool)
+
+        for i, (entry, item) in enumerate(zip(entries, items)):
+            n = num_boxes[i]
+            if entry is not None:
+                features[i, :n] = entry[0][:n]
+                image_location[i, :n] = entry[1][:n]
+                image_location_ori[i, :n] = entry[2][:n]
+                continue
+
+            decoded[i] = True
+            image_size[i] = int(item['image_w']), int(item['image_h'])
+            count = int(item['num_boxes'])
+            region_features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(count, 2048)
+            boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(count, 4)
+
+            features[i, 0] = np.sum(region_features, axis=0) / count
+            features[i, 1:n] = region_features[:n - 1]
+            image_location_ori[i, 1:n, :4] = boxes[:n - 1]
+
+        # area, normalization and the global box of all the decoded images at once.
+        image_w = image_size[decoded, 0][:, None]
+        image_h = image_size[decoded, 1][:, None]
+        location_ori = image_location_ori[decoded]
+        location_ori[:, :, 4] = (location_ori[:, :, 3] - location_ori[:, :, 1]) * (location_ori[:, :, 2] - location_ori[:, :, 0]) / (image_w * image_h)
+        location_ori[:, 0] = np.concatenate([np.zeros((len(image_w), 2)), image_w, image_h, image_w * image_h], axis=1)
+
+        location = location_ori / np.stack([image_w, image_h, image_w, image_h, np.ones_like(image_w)], axis=2)
+        location[:, 0] = [0, 0, 1, 1, 1]
+
+        image_location[decoded] = location
+        image_location_ori[decoded] = location_ori
+
+        if self._in_memory:
+            for i in np.nonzero(decoded & ~truncated)[0]:
+                n = num_boxes[i]
+                self._cache.put(indices[i], [features[i, :n], image_location[i, :n], image_location_ori[i, :n]])
 
+        num_decoded = int(decoded.sum())
+        self.stats.add(
+            reads=num_decoded,
+            bytes=sum(len(record) for record in records if record is not None),
+            decode_us=(time.perf_counter() - start) * 1e6,
+            cache_hits=batch_size - num_decoded if self._in_memory else 0,
+            cache_misses=num_decoded if self._in_memory else 0,
+        )
         return features, num_boxes, image_location, image_location_ori
 
     def keys(self) -> List[int]:
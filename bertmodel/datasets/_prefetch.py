@@ -0,0 +1,157 @@
+import multiprocessing.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.data import Dataset, Sampler
+
+
+class PrefetchBatch(list):
+    """
+    The indices of a batch, plus the upcoming indices to warm as `ahead` and
+    whether it is the `last` batch of the epoch.
+    """
+    def __init__(self, indices, ahead, last=False):
+        super(PrefetchBatch, self).__init__(indices)
+        self.ahead = ahead
+        self.last = last
+
+
+class PrefetchSampler(Sampler):
+    """
+    Batch sampler that cuts the indices of a sampler into batches, like
+    `BatchSampler`, and hands every batch the indices `lookahead` places
+    further in the order, for `PrefetchDataset` to warm. Every index is warmed
+    once, by the worker that gets the batch `lookahead` indices before it.
+
+    The sampler only looks ahead in the order and does no I/O itself: the
+    images are warmed in the DataLoader workers, so the main process holds no
+    threads or lmdb handles when the workers are forked.
+
+    Parameters
+    ----------
+    sampler : Sampler
+        The sampler to wrap, e.g. a `RandomSampler` or `DistributedSampler`.
+    batch_size : int
+        Size of the batches.
+    lookahead : int
+        Number of indices warmed ahead of the batch handed to the DataLoader.
+    drop_last : bool
+        Whether to drop the last incomplete batch.
+    """
+    def __init__(self, sampler, batch_size, lookahead=256, drop_last=False):
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.lookahead = lookahead
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        order = iter(self.sampler)
+        # the indices taken from the sampler and not handed out in a batch yet,
+        # the first `warmed` of them were handed out to be warmed.
+        window = []
+        warmed = 0
+        exhausted = False
+        while True:
+            while not exhausted and len(window) < self.batch_size + self.lookahead:
+                try:
+                    window.append(next(order))
+                except StopIteration:
+                    exhausted = True
+            if not window or (self.drop_last and len(window) < self.batch_size):
+                return
+            batch = window[:self.batch_size]
+            rest = len(window) - len(batch)
+            last = exhausted and (rest == 0 or (self.drop_last and rest < self.batch_size))
+            yield PrefetchBatch(batch, window[max(warmed, len(batch)):], last)
+            warmed = rest
+            window = window[len(batch):]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+
+class PrefetchDataset(Dataset):
+    """
+    Wraps a dataset with `prefetch` and `__getitems__` for the batches of a
+    `PrefetchSampler`. Before a batch is read, the upcoming images it carries
+    are warmed on a thread pool of the process reading it, so that the
+    following batches find them in the page cache (or in the shared
+    in-memory cache of the reader) instead of blocking on cold storage.
+
+    The pool is started in the DataLoader worker on its first batch. The
+    prefetches of images that are read before their turn came are cancelled.
+    The process that reads the last batch of the epoch cancels all its
+    pending prefetches and shuts its pool down once the batch is read, the
+    other workers do the same when they exit, which the DataLoader makes them
+    do at the end of every epoch unless `persistent_workers` is set. `close`
+    does it by hand.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        The dataset to wrap.
+    num_threads : int
+        Size of the thread pool of every worker.
+    """
+    def __init__(self, dataset, num_threads=4):
+        self.dataset = dataset
+        self.num_threads = num_threads
+        self._executor = None
+        self._finalizer = None
+        self._pid = None
+        self._pending = {}
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._pid = os.getpid()
+            self._pending = {}
+            # the DataLoader workers leave through multiprocessing, which runs
+            # the finalizers but not atexit before joining the pool threads.
+            self._finalizer = multiprocessing.util.Finalize(
+                self, PrefetchDataset._shutdown, args=(self._executor,), exitpriority=0)
+
+        for index in indices:
+            future = self._pending.pop(index, None)
+            if future is not None:
+                future.cancel()
+        for index in getattr(indices, "ahead", ()):
+            self._pending[index] = self._executor.submit(self.dataset.prefetch, index)
+        # forget the prefetches that are done.
+        self._pending = {index: future for index, future in self._pending.items() if not future.done()}
+        items = self.dataset.__getitems__(list(indices))
+        if getattr(indices, "last", False):
+            self.close()
+        return items
+
+    def close(self):
+        """Cancels the pending prefetches of this process and shuts its pool down, the next batch starts a new one."""
+        if self._pid == os.getpid():
+            self._finalizer()
+        self._executor = None
+        self._finalizer = None
+        self._pid = None
+        self._pending = {}
+
+    @staticmethod
+    def _shutdown(executor):
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_finalizer"] = None
+        state["_pid"] = None
+        state["_pending"] = {}
+        return state
@@ -0,0 +1,174 @@
+import mmap
+import multiprocessing
+import os
+
+import numpy as np
+
+
+def default_capacity_bytes(num_caches=1):
+    """The budget of a cache without one: its share of a quarter of the physical memory among `num_caches` caches."""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 4 // max(num_caches, 1)
+
+
+class SharedArrayCache(object):
+    """
+    A fixed-budget cache of numpy arrays in an anonymous shared memory arena.
+
+    The arena is mapped before the DataLoader forks its workers, so all the
+    workers of a process share one copy of every cached entry, and the cache
+    stays warm when workers are respawned for a new epoch. The arena is split
+    into equal slots, each holding one entry of up to `max_rows` rows per
+    field, and slots are recycled with the CLOCK (second chance) policy once
+    the byte budget is used up. Pages of the arena are only backed by memory
+    once an entry has been written to them.
+
+    The bookkeeping is guarded by one lock, but `get` copies an entry out of
+    its slot without it. Every slot has a version that `put` makes odd while
+    it writes the slot, a copy is only returned if the version did not change
+    meanwhile.
+
+    An access pattern that cycles over more keys than there are slots, like
+    the epochs of a sequential dataset, evicts every entry before it is read
+    again. Without `evict` the cache keeps the first entries that fit and
+    turns the others away instead.
+
+    Parameters
+    ----------
+    fields : list
+        (name, row_shape, dtype) of the arrays of one entry. Every array of an
+        entry has the same number of rows.
+    max_rows : int
+        Maximum number of rows of an entry, longer entries are not cached.
+    num_keys : int
+        Keys are integers in [0, num_keys).
+    capacity_bytes : int
+        Byte budget of the arena, None for `default_capacity_bytes`. The
+        arena is mapped whole up front, so it has to fit in memory.
+    entry_fields : list
+        (name, shape, dtype) of fixed-shape arrays of one entry, stored after
+        the row arrays.
+    evict : bool
+        Whether to evict entries once the slots are used up.
+    """
+    def __init__(self, fields, max_rows, num_keys, capacity_bytes=None, entry_fields=(), evict=True):
+        self.fields = [(name, tuple(row_shape), np.dtype(dtype)) for name, row_shape, dtype in fields]
+        self.entry_fields = [(name, tuple(shape), np.dtype(dtype)) for name, shape, dtype in entry_fields]
+        self.max_rows = max_rows
+        self.num_keys = num_keys
+        self.evict = evict
+
+        slot_bytes = sum(max_rows * int(np.prod(row_shape)) * dtype.itemsize for _, row_shape, dtype in self.fields)
+        slot_bytes += sum(int(np.prod(shape)) * dtype.itemsize for _, shape, dtype in self.entry_fields)
+        if capacity_bytes is None:
+            capacity_bytes = default_capacity_bytes()
+        num_slots = min(num_keys, int(capacity_bytes // slot_bytes))
+        self.num_slots = max(num_slots, 1)
+        self.slot_bytes = slot_bytes
+
+        # the bookkeeping lives in the arena as well. as the mapping is zero
+        # filled, slot and key ids are stored with an offset of one so that 0
+        # means empty.
+        layout = [
+            ("_slot_of_key", (num_keys,), np.int32),
+            ("_key_of_slot", (self.num_slots,), np.int64),
+            ("_rows_of_slot", (self.num_slots,), np.int32),
+            ("_referenced", (self.num_slots,), np.uint8),
+            ("_version_of_slot", (self.num_slots,), np.int64),
+            ("_counters", (3,), np.int64),  # clock hand, hits, misses
+        ]
+        layout += [(name, (self.num_slots, max_rows) + row_shape, dtype) for name, row_shape, dtype in self.fields]
+        layout += [(name, (self.num_slots,) + shape, dtype) for name, shape, dtype in self.entry_fields]
+
+        offsets = []
+        arena_bytes = 0
+        for _, shape, dtype in layout:
+            arena_bytes = (arena_bytes + 63) // 64 * 64
+            offsets.append(arena_bytes)
+            arena_bytes += int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        self._arena = mmap.mmap(-1, max(arena_bytes, 1))
+        self._data = {}
+        for (name, shape, dtype), offset in zip(layout, offsets):
+            array = np.frombuffer(self._arena, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+            if name.startswith("_"):
+                setattr(self, name, array)
+            else:
+                self._data[name] = array
+
+        self._lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return int(np.count_nonzero(self._key_of_slot))
+
+    def __contains__(self, key):
+        return self._slot_of_key[key] != 0
+
+    def get(self, key):
+        """Returns copies of the cached arrays of `key`, or None on a miss."""
+        while True:
+            with self._lock:
+                slot = int(self._slot_of_key[key]) - 1
+                if slot < 0:
+                    self._counters[2] += 1
+                    return None
+                self._referenced[slot] = 1
+                # puts hold the lock, so the version is even here.
+                version = int(self._version_of_slot[slot])
+                rows = int(self._rows_of_slot[slot])
+
+            arrays = [self._data[name][slot, :rows].copy() for name, _, _ in self.fields]
+            arrays += [self._data[name][slot].copy() for name, _, _ in self.entry_fields]
+
+            # the slot was recycled during the copy: look the key up again.
+            if self._version_of_slot[slot] != version or self._key_of_slot[slot] != key + 1:
+                continue
+            with self._lock:
+                self._counters[1] += 1
+            return arrays
+
+    def put(self, key, arrays):
+        """Caches `arrays` (one per field, then one per entry field) under `key`, evicting if needed."""
+        rows = arrays[0].shape[0]
+        if rows > self.max_rows:
+            return False
+
+        with self._lock:
+            if self._slot_of_key[key] != 0:
+                return True
+
+            # CLOCK: skip (and clear) recently referenced slots.
+            hand = int(self._counters[0])
+            if not self.evict and self._key_of_slot[hand] != 0:
+                return False
+            while self.evict and self._referenced[hand]:
+                self._referenced[hand] = 0
+                hand = (hand + 1) % self.num_slots
+            slot = hand
+            self._counters[0] = (hand + 1) % self.num_slots
+
+            evicted = int(self._key_of_slot[slot]) - 1
+            if evicted >= 0:
+                self._slot_of_key[evicted] = 0
+
+            self._version_of_slot[slot] += 1
+            for (name, _, _), array in zip(self.fields, arrays):
+                self._data[name][slot, :rows] = array
+            for (name, _, _), array in zip(self.entry_fields, arrays[len(self.fields):]):
+                self._data[name][slot] = array
+            self._version_of_slot[slot] += 1
+            self._rows_of_slot[slot] = rows
+            self._key_of_slot[slot] = key + 1
+            self._slot_of_key[key] = slot + 1
+            self._referenced[slot] = 1
+        return True
+
+    def stats(self):
+        hits = int(self._counters[1])
+        misses = int(self._counters[2])
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / float(max(hits + misses, 1)),
+            "entries": len(self),
+            "slots": self.num_slots,
+        }
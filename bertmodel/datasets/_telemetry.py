@@ -0,0 +1,67 @@
+import mmap
+import multiprocessing
+
+import numpy as np
+from torch.utils.data import get_worker_info
+
+READER_STATS_FIELDS = (
+    "reads",          # records (images) read from storage
+    "bytes",          # bytes read from storage
+    "decode_us",      # time spent unpickling / decoding / dequantizing
+    "cache_hits",     # images served by the in-memory cache
+    "cache_misses",
+    "region_slots",   # padded region slots handed to the model
+    "region_rows",    # of which hold an actual region
+    "prefetch_reads", # records read ahead only to warm the page cache
+    "prefetch_bytes",
+)
+
+
+class ReaderStats(object):
+    """
+    Counters of a feature reader, kept per DataLoader worker.
+
+    The counters live in an anonymous shared mapping created before the
+    workers are forked, so the main process can read what every worker
+    recorded. Row 0 is the main process, row `i + 1` is worker `i`, prefetch
+    threads count with their process.
+
+    Parameters
+    ----------
+    max_workers : int
+        Number of worker rows, workers beyond it share rows.
+    """
+    def __init__(self, max_workers: int = 64):
+        self.num_rows = max_workers + 1
+        num_fields = len(READER_STATS_FIELDS)
+        self._buffer = mmap.mmap(-1, self.num_rows * num_fields * 8)
+        self._counts = np.frombuffer(self._buffer, dtype=np.int64).reshape(self.num_rows, num_fields)
+        self._field_index = {name: i for i, name in enumerate(READER_STATS_FIELDS)}
+        self._lock = multiprocessing.Lock()
+
+    def add(self, **values):
+        worker_info = get_worker_info()
+        row = 0 if worker_info is None else worker_info.id % (self.num_rows - 1) + 1
+        with self._lock:
+            for name, value in values.items():
+                self._counts[row, self._field_index[name]] += int(value)
+
+    def snapshot(self):
+        """Copy of the counters, [num_rows, len(READER_STATS_FIELDS)]."""
+        with self._lock:
+            return self._counts.copy()
+
+    @staticmethod
+    def summary(counts):
+        """Derived figures of a (delta of) snapshot, summed over the workers."""
+        totals = dict(zip(READER_STATS_FIELDS, counts.sum(axis=0).tolist()))
+        lookups = totals["cache_hits"] + totals["cache_misses"]
+        return {
+            "reads": totals["reads"],
+            "MB": totals["bytes"] / float(1 << 20),
+            "prefetch_MB": totals["prefetch_bytes"] / float(1 << 20),
+            "decode_ms": totals["decode_us"] / 1000.0,
+            "decode_us_per_read": totals["decode_us"] / float(max(totals["reads"], 1)),
+            "hit_rate": totals["cache_hits"] / float(max(lookups, 1)),
+            "pad_waste": (totals["region_slots"] - totals["region_rows"]) / float(max(totals["region_slots"], 1)),
+        }
@@ -1,15 +1,17 @@
-import copy
 import json
 import logging
+import multiprocessing
 import os
 import random
+import re
 
 import lmdb
 import numpy as np
-import tensorpack.dataflow as td
+from tensorpack.utils.serialize import loads
 
 import torch
-from torch.utils.data import Dataset
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 from torch.utils.data.sampler import Sampler
 import torch.distributed as dist
 import sys
@@ -18,6 +20,10 @@ import pdb
 import scipy
 from scipy.spatial import distance
 
+from ._caption_store import CaptionStore, is_caption_store, vocab_checksum
+from ._image_features_reader import _open_lmdb_env
+from ._shared_cache import SharedArrayCache
+
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
     datefmt="%m/%d/%Y %H:%M:%S",
@@ -26,92 +32,672 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def iou_numpy(boxes_1, boxes_2, width, height):
+def iou_batch(boxes_1, boxes_2, width, height):
     """
-    boxes_1: (N_1, 5) ndarray of float (normalized)
-    boxes_2: (N_2, 5) ndarray of float (normalized)
-    overlaps: (N_1, N_2) ndarray of iou overlap between every pair of boxes
+    boxes_1: (B, N_1, 5) ndarray of float (normalized)
+    boxes_2: (B, N_2, 5) ndarray of float (normalized)
+    width, height: (B,) ndarray of the image sizes
+    overlaps: (B, N_1, N_2) ndarray of iou overlap between every pair of boxes of each image
     """
-    N_1 = boxes_1.shape[0]
-    N_2 = boxes_2.shape[0]
+    pixel_w = (1.0 / np.asarray(width, dtype=np.float32))[:, None, None]
+    pixel_h = (1.0 / np.asarray(height, dtype=np.float32))[:, None, None]
+    boxes_1 = boxes_1[:, :, None, :]
+    boxes_2 = boxes_2[:, None, :, :]
+
+    boxes_1_area = (boxes_1[..., 2] - boxes_1[..., 0] + pixel_w) * (boxes_1[..., 3] - boxes_1[..., 1] + pixel_h)
+    boxes_2_area = (boxes_2[..., 2] - boxes_2[..., 0] + pixel_w) * (boxes_2[..., 3] - boxes_2[..., 1] + pixel_h)
+
+    iw = np.minimum(boxes_1[..., 2], boxes_2[..., 2]) - np.maximum(boxes_1[..., 0], boxes_2[..., 0]) + pixel_w
+    ih = np.minimum(boxes_1[..., 3], boxes_2[..., 3]) - np.maximum(boxes_1[..., 1], boxes_2[..., 1]) + pixel_h
+    intersection = np.maximum(iw, 0) * np.maximum(ih, 0)
 
-    boxes_1_area = ((boxes_1[:,2] - boxes_1[:,0] + 1.0 / width) *
-                (boxes_1[:,3] - boxes_1[:,1] + 1.0 / height)).reshape(1, N_1)
+    return intersection / (boxes_1_area + boxes_2_area - intersection)
 
-    boxes_2_area = ((boxes_2[:,2] - boxes_2[:,0] + 1.0 / width) *
-                (boxes_2[:,3] - boxes_2[:,1] + 1.0 / height)).reshape(N_2, 1)
 
-    boxes_1_expand = np.tile(boxes_1.reshape(N_1, 1, 5), [1, N_2, 1])
-    boxes_2_expand = np.tile(boxes_2.reshape(1, N_2, 5), [N_1, 1, 1])
+class BatchMasker(object):
+    """
+    Masked language / region modeling of a whole collated batch, with the
+    probabilities of `random_word` and `random_region` in the original BERT
+    paper: 15% of the tokens (80% [MASK], 10% random token, 10% kept) and 15%
+    of the regions (90% zeroed), or one random span of tokens and the regions
+    overlapping 10% of seed regions with `span_mask`.
+
+    With `cond_mask` every batch gives two views: the caption is kept and the
+    regions are masked, then the regions are kept and the caption is masked.
+    """
+    def __init__(self, tokenizer, span_mask=False, cond_mask=False, visualization=False, rng=None):
+        self.mask_id = tokenizer.vocab["[MASK]"]
+        self.vocab_ids = np.array(list(tokenizer.vocab.values()), dtype=np.int64)
+        self.span_mask = span_mask
+        self.cond_mask = cond_mask
+        self.visualization = visualization
+        self.rng = np.random.RandomState() if rng is None else rng
+
+    def mask_tokens(self, input_ids, input_mask):
+        """Masks input_ids in place, returns the lm_label_ids (-1 for the tokens not to predict)."""
+        batch_size, seq_len = input_ids.shape
+        # the caption is input_ids[1:num_tokens + 1], between [CLS] and [SEP].
+        num_tokens = input_mask.sum(axis=1) - 2
+        positions = np.arange(seq_len)[None, :] - 1
+        caption = (positions >= 0) & (positions < num_tokens[:, None])
+
+        if self.span_mask:
+            # one span of random length starting anywhere in the caption.
+            start = (self.rng.random_sample(batch_size) * (num_tokens + 1)).astype(np.int64)
+            length = 1 + (self.rng.random_sample(batch_size) * num_tokens).astype(np.int64)
+            has_span = (num_tokens * 0.3).astype(np.int64) > 0
+            masked = caption & has_span[:, None] & (positions >= start[:, None]) & (positions < (start + length)[:, None])
+        elif self.visualization:
+            masked = np.zeros_like(caption)
+        else:
+            masked = caption & (self.rng.random_sample(caption.shape) < 0.15)
+
+        lm_label_ids = np.where(masked, input_ids, -1)
+        prob = self.rng.random_sample(caption.shape)
+        input_ids[masked & (prob < 0.8)] = self.mask_id
+        replaced = masked & (prob >= 0.8) & (prob < 0.9)
+        input_ids[replaced] = self.vocab_ids[self.rng.randint(len(self.vocab_ids), size=int(replaced.sum()))]
+        return lm_label_ids
 
-    iw = np.where(boxes_1_expand[:,:,2] < boxes_2_expand[:,:,2], boxes_1_expand[:,:,2], boxes_2_expand[:,:,2]) - \
-        np.where(boxes_1_expand[:,:,0] > boxes_2_expand[:,:,0], boxes_1_expand[:,:,0], boxes_2_expand[:,:,0]) + 1.0 / width
-    iw[iw < 0] = 0
+    def mask_regions(self, image_loc, image_mask, image_w, image_h):
+        """
+        The image_label (1 for the masked regions) and the boolean mask of the
+        regions whose features are to be zeroed.
+        """
+        regions = image_mask == 1
+        if self.visualization:
+            return np.full(regions.shape, -1, dtype=np.int64), np.zeros_like(regions)
+
+        if self.span_mask:
+            # every region overlapping a seed region is masked.
+            seeds = regions & (self.rng.random_sample(regions.shape) < 0.1)
+            overlaps = iou_batch(image_loc, image_loc, image_w, image_h) >= 0.4
+            masked = (overlaps & seeds[:, :, None]).any(axis=1) & regions
+            zeroed = masked
+        else:
+            masked = regions & (self.rng.random_sample(regions.shape) < 0.15)
+            zeroed = masked & (self.rng.random_sample(regions.shape) < 0.9)
 
-    ih = np.where(boxes_1_expand[:,:,3] < boxes_2_expand[:,:,3], boxes_1_expand[:,:,3], boxes_2_expand[:,:,3]) - \
-        np.where(boxes_1_expand[:,:,1] > boxes_2_expand[:,:,1], boxes_1_expand[:,:,1], boxes_2_expand[:,:,1]) + 1.0 / height
-    ih[ih < 0] = 0
+        return np.where(masked, 1, -1), zeroed
 
-    ua = boxes_1_area + boxes_2_area - (iw * ih)
-    overlaps = iw * ih / ua
+    def __call__(self, batch):
+        """
+        Masks a batch of `BertPreprocessBatch.new_batch` in place, row 0 of the
+        region arrays (the global region) is left alone.
 
-    return overlaps
+        With `cond_mask` the batch is the one of the regions kept and the caption
+        masked, plus the regions to zero for the other view as a last field. Both
+        views share the image data, `cond_mask_views` splits them.
+        """
+        input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
+        image_loc, image_target, image_label, image_mask, multimodal_mask, image_id, image_w, image_h = batch
+        lm_label_ids, image_label, zeroed = self.mask_batch(batch)
 
+        if not self.cond_mask:
+            image_feat[:, 1:][zeroed] = 0
+            return (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
+                image_loc, image_target, image_label, image_mask, multimodal_mask, image_id)
 
-class InputExample(object):
-    """A single training/test example for the language model."""
+        zeroed_rows = np.zeros(image_mask.shape, dtype=bool)
+        zeroed_rows[:, 1:] = zeroed
+        return (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
+            image_loc, image_target, image_label, image_mask, multimodal_mask, image_id, zeroed_rows)
 
-    def __init__(
-        self, image_feat=None, image_target=None, caption=None, is_next=None, lm_labels=None, image_loc=None, num_boxes=None, image_w=None, image_h=None
-    ):
-        """Constructs a InputExample.
-        Args:
-            guid: Unique id for the example.
-            tokens_a: string. The untokenized text of the first sequence. For single
-            sequence tasks, only this sequence must be specified.
-            tokens_b: (Optional) string. The untokenized text of the second sequence.
-            Only must be specified for sequence pair tasks.
-            label: (Optional) string. The label of the example. This should be
-            specified for train and dev examples, but not for test examples.
+    def mask_batch(self, batch):
         """
-        self.image_feat = image_feat
-        self.caption = caption
-        self.is_next = is_next  # nextSentence
-        self.lm_labels = lm_labels  # masked words for language model
-        self.image_loc = image_loc
-        self.image_target = image_target
-        self.num_boxes = num_boxes
-        self.image_w = image_w
-        self.image_h = image_h
-
-class InputFeatures(object):
-    """A single set of features of data."""
+        Masks the input_ids of a `new_batch` batch in place, returns the
+        lm_label_ids, the image_label and the regions to zero, without the
+        global region.
+        """
+        input_ids, input_mask, image_loc, image_mask, image_w, image_h = \
+            batch[0], batch[1], batch[6], batch[9], batch[12], batch[13]
+        regions = (image_loc[:, 1:], image_mask[:, 1:], image_w, image_h)
+        if self.cond_mask:
+            image_label, zeroed = self.mask_regions(*regions)
+            lm_label_ids = self.mask_tokens(input_ids, input_mask)
+        else:
+            lm_label_ids = self.mask_tokens(input_ids, input_mask)
+            image_label, zeroed = self.mask_regions(*regions)
+        return lm_label_ids, image_label, zeroed
+
+
+def cond_mask_views(batch):
+    """
+    The two views of a cond_mask batch of tensors: the caption kept and the
+    regions masked, then the regions kept and the caption masked. Only the
+    image features of the first view are a new tensor.
+    """
+    input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
+    image_loc, image_target, image_label, image_mask, multimodal_mask, image_id, zeroed = batch
+
+    # the labels of the masked tokens are the original ids.
+    text_input_ids = torch.where(lm_label_ids != -1, lm_label_ids, input_ids)
+    text_image_feat = image_feat.masked_fill(zeroed.unsqueeze(2), 0)
+    text_image_feat[:, 0] = text_image_feat[:, 1:].sum(dim=1) / image_mask[:, 1:].sum(dim=1, keepdim=True)
+    text_view = (text_input_ids, input_mask, segment_ids, torch.full_like(lm_label_ids, -1), is_next, text_image_feat, \
+        image_loc, image_target, image_label, image_mask, multimodal_mask, image_id)
+
+    img_view = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
+        image_loc, image_target, torch.full_like(image_label, -1), image_mask, multimodal_mask, image_id)
+    return [text_view, img_view]
+
+
+def in_batch_negatives(batch, hard=False, generator=None):
+    """
+    ITM negatives of a batch of positive pairs (see `in_batch_negatives` of the
+    loaders): half of the images get the caption of another image of the batch
+    and is_next 1. With `hard`, that is the image whose global region is the
+    most similar, otherwise a random one. It runs on the CPU tensors of the
+    collated batch in the loader workers, before `cond_mask_views`, and the
+    draws come from `generator`, which `ConceptCapStream.reseed` seeds for
+    every batch.
+    """
+    input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
+    image_loc, image_target, image_label, image_mask, multimodal_mask, image_id = batch
+    batch_size, seq_len = input_ids.shape
+    rows = torch.arange(batch_size)
+    # captions of one image share the image id but its last digit.
+    same_image = (image_id // 10).unsqueeze(0) == (image_id // 10).unsqueeze(1)
+
+    if hard:
+        g_image_feat = F.normalize(image_feat[:, 0].float(), dim=1)
+        similarity = torch.mm(g_image_feat, g_image_feat.t()).masked_fill(same_image, float("-inf"))
+        other = similarity.argmax(dim=1)
+    else:
+        other = (rows + torch.randint(1, max(batch_size, 2), (batch_size,), generator=generator)) % batch_size
+
+    negative = (torch.rand(batch_size, generator=generator) < 0.5) & ~same_image[rows, other]
+    other = torch.where(negative, other, rows)
+
+    multimodal_mask = multimodal_mask.clone()
+    multimodal_mask[:, -seq_len:] = multimodal_mask[other, -seq_len:]
+    return (input_ids[other], input_mask[other], segment_ids[other], lm_label_ids[other], negative.to(is_next.dtype), \
+        image_feat, image_loc, image_target, image_label, image_mask, multimodal_mask, image_id)
+
+
+def topk_image_target(image_target, k, num_rows):
+    """
+    The k most likely classes of every region of the [num_boxes, 1601] class
+    distributions, as [num_rows, k, 2] (class index, probability) with zero
+    padded rows. `InterBertForMultiModalPreTraining` densifies the masked rows.
+    """
+    image_target = np.asarray(image_target, dtype=np.float32)
+    k = min(k, image_target.shape[1])
+    classes = np.argpartition(-image_target, k - 1, axis=1)[:, :k]
+    sparse = np.zeros((num_rows, k, 2), dtype=np.float32)
+    sparse[:len(image_target), :, 0] = classes
+    sparse[:len(image_target), :, 1] = np.take_along_axis(image_target, classes, axis=1)
+    return sparse
+
+
+def fill_global_region(batch):
+    """Writes the global region, the mean of the (masked) regions, into the reserved row 0 of a batch."""
+    image_feat, image_loc, image_mask, multimodal_mask = batch[5], batch[6], batch[9], batch[10]
+    np.sum(image_feat[:, 1:], axis=1, out=image_feat[:, 0])
+    image_feat[:, 0] /= np.sum(image_mask[:, 1:], axis=1, keepdims=True)
+    image_loc[:, 0] = [0, 0, 1, 1, 1]
+    image_mask[:, 0] = 1
+    multimodal_mask[:, 0] = 1
+
+
+def trim_text(batch):
+    """Cuts the text of a `new_batch` batch, and its part of multimodal_mask, to the longest caption."""
+    seq_len = batch[0].shape[1]
+    num_tokens = int(batch[1].sum(axis=1).max())
+    for j in (0, 1, 2, 3):
+        batch[j] = np.ascontiguousarray(batch[j][:, :num_tokens])
+    batch[10] = np.ascontiguousarray(batch[10][:, :batch[10].shape[1] - seq_len + num_tokens])
+
+
+def shuffle_buffer(items, size, rng):
+    """
+    Yields `items` in a random order with at most `size` of them held at once:
+    every new item takes the place of a random one of the buffer, which is
+    yielded, the remaining buffer is shuffled at the end.
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    for item in buffer:
+        yield item
+
 
+def _open_serialized_lmdb(lmdb_file):
+    # the records are read in order, unlike the image features.
+    return _open_lmdb_env(lmdb_file, subdir=os.path.isdir(lmdb_file), readahead=True)
+
+
+def lmdb_num_records(lmdb_file):
+    """Number of records of a tensorpack LMDBSerializer file."""
+    with _open_serialized_lmdb(lmdb_file).begin(write=False) as txn:
+        return txn.stat()["entries"] - (txn.get(b"__keys__") is not None)
+
+
+def training_shards(corpus_path, distributed=False):
+    """
+    The lmdb files of the training records, the `training_feat_part_<i>.lmdb`
+    shards in order or `training_feat_all.lmdb`. The shards are preferred in
+    distributed training, the single file otherwise.
+    """
+    parts = {}
+    for name in os.listdir(corpus_path):
+        match = re.match(r"training_feat_part_(\d+)\.lmdb$", name)
+        if match:
+            parts[int(match.group(1))] = os.path.join(corpus_path, name)
+    all_file = os.path.join(corpus_path, "training_feat_all.lmdb")
+    if parts and (distributed or not os.path.exists(all_file)):
+        return [parts[i] for i in sorted(parts)]
+    return [all_file]
+
+
+class ShardedRecords(object):
+    """
+    The records of several tensorpack LMDBSerializer files as one sequence,
+    split between `world_size` ranks. Rank `r` gets the contiguous records
+    [r * n, (r + 1) * n) of the sequence, with n the number of records over
+    the world size, so every rank has as many records (the few left over are
+    dropped) and a range may span several files. Any number of shards can
+    be read by any number of ranks.
+    """
+    def __init__(self, lmdb_files, rank=0, world_size=1):
+        self.lmdb_files = list(lmdb_files)
+        self.offsets = np.cumsum([0] + [lmdb_num_records(lmdb_file) for lmdb_file in self.lmdb_files])
+        num_records = int(self.offsets[-1]) // world_size
+        self.start = rank * num_records
+        self.stop = self.start + num_records
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def begin(self):
+        """A reader of the records of the rank by their index in the range, to use in a `with` block."""
+        return _ShardReader(self)
+
+
+class _ShardReader(object):
+    def __init__(self, shards):
+        self.shards = shards
+        self._txns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for txn in self._txns.values():
+            txn.abort()
+        self._txns = {}
+
+    def get(self, i):
+        """The serialized record `i` of the range."""
+        i += self.shards.start
+        shard = int(np.searchsorted(self.shards.offsets, i, side="right")) - 1
+        if shard not in self._txns:
+            self._txns[shard] = _open_serialized_lmdb(self.shards.lmdb_files[shard]).begin(write=False)
+        return self._txns[shard].get(u"{:08}".format(i - int(self.shards.offsets[shard])).encode("ascii"))
+
+
+class RecordCache(object):
+    """
+    Decoded, unmasked records of a ConceptCap lmdb file in shared memory, by
+    record index. The epochs after the first read the cached records without
+    touching the lmdb file or unpickling them, the masks and NSP captions are
+    still drawn from them every pass.
+
+    A sequential pass over more records than fit would evict every record
+    before it is read again, so the cache keeps the first records that fit in
+    `capacity_bytes` and the others are read from the lmdb file every epoch.
+
+    Parameters
+    ----------
+    num_records : int
+        Number of records of the lmdb file.
+    capacity_bytes : int
+        Memory budget of the cache, about 0.5 MB per record of 36 regions.
+    region_len : int
+        Maximum number of regions of a record.
+    max_text_bytes : int
+        Records with a longer utf-8 image id plus caption are not cached.
+    """
+    def __init__(self, num_records, capacity_bytes, region_len=36, max_text_bytes=1024):
+        self.max_text_bytes = max_text_bytes
+        self._cache = SharedArrayCache(
+            [("features", (2048,), np.float32), ("targets", (1601,), np.float32), ("boxes", (4,), np.float32)],
+            max_rows=region_len,
+            num_keys=num_records,
+            capacity_bytes=capacity_bytes,
+            entry_fields=[("size", (2,), np.float64), ("text", (max_text_bytes,), np.uint8)],
+            evict=False,
+        )
+
+    def get(self, index):
+        """The record `index` as read from the lmdb file, or None on a miss."""
+        arrays = self._cache.get(index)
+        if arrays is None:
+            return None
+        features, targets, boxes, size, text = arrays
+        image_id, caption = text.tobytes().rstrip(b"\0").decode("utf-8").split("\n", 1)
+        return [features, targets, boxes, features.shape[0], size[0], size[1], image_id, caption]
+
+    def put(self, index, record):
+        image_feature_wp, image_target_wp, image_location_wp, num_boxes, image_h, image_w, image_id, caption = record
+        text = (u"%s\n%s" % (image_id, caption)).encode("utf-8")
+        if len(text) > self.max_text_bytes:
+            return False
+        text_array = np.zeros(self.max_text_bytes, dtype=np.uint8)
+        text_array[:len(text)] = np.frombuffer(text, dtype=np.uint8)
+        num_boxes = int(num_boxes)
+        return self._cache.put(index, [
+            image_feature_wp[:num_boxes],
+            image_target_wp[:num_boxes],
+            image_location_wp[:num_boxes],
+            np.array([image_h, image_w], dtype=np.float64),
+            text_array,
+        ])
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class ConceptCapStream(IterableDataset):
+    """
+    The records of tensorpack LMDBSerializer files (`ShardedRecords`),
+    preprocessed, collated, masked and turned into tensors inside the
+    DataLoader workers.
+
+    The stream is cut into blocks of `bucket_batches` batches of consecutive
+    records, and worker `w` reads the blocks `blocks()[w::num_workers]`, each
+    as a stretch of contiguous records. The DataLoader takes the batches from
+    the workers in turn: with one batch per block and no shuffling, batch `k`
+    comes from worker `k % num_workers` and the records of the batches come in
+    file order whatever the number of workers. A trailing incomplete batch is
+    dropped.
+
+    The records are written straight into the buffers of one batch, which
+    become the tensors without another copy. With `trim_padding` the buffers
+    hold as many regions as the largest image of the batch and the text is cut
+    to the longest caption, instead of `region_len` and `seq_len`.
+
+    With `bucket_batches` > 1 a worker reads that many batches of records at
+    once, sorts them by caption length plus number of regions and cuts the
+    batches from the sorted records, in a random order. Batches of similar
+    lengths are padded less, the records of a batch still come from the same
+    stretch of the file.
+
+    With `shuffle_blocks` the blocks of `bucket_batches` batches are handed
+    to the workers in a new order every epoch, the same in all the workers,
+    and the records of a block are still read in order. `shuffle_buffer`
+    passes the records of a worker through a buffer of that many decoded
+    records (about 0.5 MB each with the dense image targets) which yields
+    them in a random order, so a batch mixes records of several blocks.
+
+    With a `RecordCache` the records are looked up in it before the lmdb file
+    and cached once read.
+
+    `build_masks` draws the masks, NSP captions and padding of every batch
+    once. Once they are set as `masks` the stream replays them and only the
+    image data is read, every pass gives the same batches, the in-batch
+    negatives included.
+
+    With `in_batch_negatives` the records are positive pairs and the ITM
+    negatives are made by `in_batch_negatives` once the batch is masked, the
+    two views of a `cond_mask` batch share them.
+
+    The masking and the NSP negatives of a batch are drawn from (seed, epoch,
+    worker id, number of the batch in the worker). `set_epoch` reaches
+    persistent workers through shared memory, so new masks do not need new
+    workers. The stream yields (worker id, batch) pairs, and `fast_forward`
+    resumes every worker after the batches it already gave, without
+    preprocessing them. The records of those batches are not read again,
+    except in two cases. With `bucket_batches` > 1 the block the worker
+    stopped in is read whole, its batches are cut from all its records
+    sorted. With `shuffle_buffer` the records are skipped in the order they
+    enter the buffer, not the order it yields them in: the first
+    `shuffle_buffer` records after the skipped ones, which had entered the
+    buffer before the stop, are read to refill it, and those of them that
+    went into batches already given are dropped once read.
+    """
     def __init__(
         self,
-        input_ids=None,
-        input_mask=None,
-        segment_ids=None,
-        is_next=None,
-        lm_label_ids=None,
-        image_feat=None,
-        image_target=None,
-        image_loc=None,
-        image_label=None,
-        image_mask=None,
-        multimodal_mask=None
+        records,
+        preprocess_function,
+        masker,
+        batch_size,
+        seed=0,
+        trim_padding=False,
+        bucket_batches=1,
+        shuffle_blocks=False,
+        shuffle_buffer=0,
+        cache=None,
+        num_workers=0,
+        in_batch_negatives=False,
+        hard_negatives=False,
     ):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.is_next = is_next
-        self.lm_label_ids = lm_label_ids
-        self.image_feat = image_feat
-        self.image_loc = image_loc
-        self.image_label = image_label
-        self.image_target = image_target
-        self.image_mask = image_mask
-        self.multimodal_mask = multimodal_mask
+        self.records = records
+        self.preprocess_function = preprocess_function
+        self.masker = masker
+        self.batch_size = batch_size
+        self.num_records = len(records)
+        self.seed = seed
+        self.trim_padding = trim_padding
+        self.bucket_batches = max(bucket_batches, 1)
+        self.shuffle_blocks = shuffle_blocks
+        self.shuffle_buffer = shuffle_buffer
+        self.cache = cache
+        self.in_batch_negatives = in_batch_negatives
+        self.hard_negatives = hard_negatives
+        self.generator = torch.Generator()
+        self.masks = None
+        self._epoch = multiprocessing.RawValue("q", 0)
+        self._skip = multiprocessing.RawArray("q", max(num_workers, 1))
+
+    def __len__(self):
+        return self.num_records // self.batch_size
+
+    def set_epoch(self, epoch):
+        self._epoch.value = epoch
+
+    def fast_forward(self, consumed):
+        """Skips the first `consumed[w]` batches of every worker `w` in the next pass."""
+        self._skip[:] = consumed
+
+    def _seed(self, epoch, *keys):
+        return int(np.random.SeedSequence([self.seed, epoch] + list(keys)).generate_state(1)[0])
+
+    def reseed(self, epoch, worker_id, t):
+        """Seeds the masking and the NSP negatives of batch `t` of a worker."""
+        seed = self._seed(epoch, worker_id, t, 2)
+        self.masker.rng.seed(seed)
+        self.preprocess_function.rng.seed(seed)
+        self.generator.manual_seed(seed)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        epoch = self._epoch.value
+        skip = self._skip[worker_id]
+
+        if self.masks is not None:
+            with self.records.begin() as txn:
+                for k in range(worker_id + skip * num_workers, len(self.masks), num_workers):
+                    yield worker_id, self.replay(txn, k)
+            return
+
+        # the stream of a worker is cut into windows of the records of a block,
+        # batch t of the worker is the t-th batch cut from them.
+        blocks = self.blocks()[worker_id::num_workers]
+        block_size = self.bucket_batches * self.batch_size
+        with self.records.begin() as txn:
+            indices = (i for block in blocks for i in self.block_indices(block))
+            records = {}
+            if self.shuffle_buffer > 0:
+                indices = shuffle_buffer(
+                    self.read_ahead(txn, indices, records, skip * self.batch_size),
+                    self.shuffle_buffer,
+                    random.Random(self._seed(epoch, worker_id)),
+                )
+            t = 0
+            window = []
+            for i in indices:
+                window.append(i)
+                if len(window) == block_size:
+                    for batch in self.batches(txn, window, records, epoch, worker_id, t, skip):
+                        yield worker_id, batch
+                    t += len(window) // self.batch_size
+                    window = []
+            for batch in self.batches(txn, window, records, epoch, worker_id, t, skip):
+                yield worker_id, batch
+
+    def blocks(self):
+        """The blocks of `bucket_batches` batches, in the order of the epoch."""
+        blocks = np.arange((len(self) + self.bucket_batches - 1) // self.bucket_batches)
+        if self.shuffle_blocks:
+            np.random.RandomState(
+                np.random.SeedSequence([self.seed, self._epoch.value]).generate_state(1)[0]
+            ).shuffle(blocks)
+        return blocks
+
+    def block_indices(self, block):
+        first = block * self.bucket_batches * self.batch_size
+        last = min((block + 1) * self.bucket_batches, len(self)) * self.batch_size
+        return range(first, last)
+
+    def read_ahead(self, txn, indices, records, skip_records):
+        """Reads the records into `records` in file order, but the first `skip_records`, and passes the indices on."""
+        for n, i in enumerate(indices):
+            if n >= skip_records:
+                records[i] = self.read(txn, i)
+            yield i
+
+    def read(self, txn, i):
+        record = self.cache.get(i) if self.cache is not None else None
+        if record is None:
+            record = loads(txn.get(i))
+            if self.cache is not None:
+                self.cache.put(i, record)
+        return record
+
+    def batches(self, txn, indices, records, epoch, worker_id, first, skip):
+        """
+        Batches `first`, `first + 1`, ... of a worker, preprocessed from the
+        records at `indices` (a multiple of batch_size), sorted by length with
+        `bucket_batches`. The batches before `skip` are left out.
+        """
+        num_batches = len(indices) // self.batch_size
+        if first + num_batches <= skip:
+            for i in indices:
+                records.pop(i, None)
+            return
+        window = [records.pop(i) if i in records else self.read(txn, i) for i in indices]
+        if self.bucket_batches > 1:
+            window.sort(key=self.preprocess_function.sample_length)
+        batches = [window[i:i + self.batch_size] for i in range(0, len(window), self.batch_size)]
+        if self.bucket_batches > 1:
+            random.Random(self._seed(epoch, worker_id, first, 1)).shuffle(batches)
+        for t, batch_records in enumerate(batches, first):
+            if t < skip:
+                continue
+            self.reseed(epoch, worker_id, t)
+            yield self.collate(self.make_batch(batch_records))
+
+    def make_batch(self, records):
+        num_regions = None
+        if self.trim_padding:
+            num_regions = max(int(record[3]) for record in records)
+        batch = self.preprocess_function.new_batch(len(records), num_regions)
+        for i, record in enumerate(records):
+            self.preprocess_function.fill(batch, i, record)
+        if self.trim_padding:
+            trim_text(batch)
+        return batch
+
+    def collate(self, batch):
+        batch = self.masker(batch)
+        fill_global_region(batch)
+        # the tensors share the memory of the arrays, the DataLoader moves them to shared memory.
+        return self.negatives(tuple(torch.from_numpy(data) for data in batch))
+
+    def negatives(self, batch):
+        """The batch with its ITM negatives with `in_batch_negatives`, the cond_mask regions to zero stay last."""
+        if not self.in_batch_negatives:
+            return batch
+        return in_batch_negatives(batch[:12], hard=self.hard_negatives, generator=self.generator) + batch[12:]
+
+    def build_masks(self):
+        """
+        The caption, masks and labels of every batch of consecutive records,
+        those of a pass of epoch 0 in the main process, as dicts of tensors
+        for `masks`. The regions to zero are kept as `zeroed` and the text is
+        kept trimmed.
+        """
+        masks = []
+        with self.records.begin() as txn:
+            for k in range(len(self)):
+                self.reseed(0, 0, k)
+                batch = self.make_batch([self.read(txn, k * self.batch_size + i) for i in range(self.batch_size)])
+                lm_label_ids, image_label, zeroed = self.masker.mask_batch(batch)
+                fields = {
+                    "input_ids": batch[0],
+                    "input_mask": batch[1],
+                    "segment_ids": batch[2],
+                    "lm_label_ids": lm_label_ids,
+                    "is_next": batch[4],
+                    "image_label": image_label,
+                    "zeroed": zeroed,
+                }
+                masks.append({name: torch.from_numpy(data) for name, data in fields.items()})
+        return masks
+
+    def replay(self, txn, k):
+        """Batch `k` of `masks`, with the image data read again."""
+        masks = self.masks[k]
+        zeroed = masks["zeroed"].numpy()
+        batch = self.preprocess_function.new_batch(self.batch_size, zeroed.shape[1])
+        for i in range(self.batch_size):
+            self.preprocess_function.fill_image(batch, i, self.read(txn, k * self.batch_size + i))
+        for j, name in enumerate(("input_ids", "input_mask", "segment_ids", "lm_label_ids", "is_next")):
+            batch[j] = masks[name].numpy()
+        batch[8] = masks["image_label"].numpy()
+        batch[10] = np.concatenate([batch[9], batch[1]], axis=1)
+
+        if self.masker.cond_mask:
+            zeroed_rows = np.zeros(batch[9].shape, dtype=bool)
+            zeroed_rows[:, 1:] = zeroed
+            batch = batch[:12] + [zeroed_rows]
+        else:
+            batch[5][:, 1:][zeroed] = 0
+            batch = batch[:12]
+        fill_global_region(batch)
+        # the ITM negatives are drawn from the batch number as well.
+        self.reseed(0, 0, k)
+        return self.negatives(tuple(torch.from_numpy(data) for data in batch))
+
+
+def load_masks(path, stream, config):
+    """
+    The `build_masks` of `stream` saved at `path`, rebuilt and saved again if
+    missing or drawn with another `config`.
+    """
+    if os.path.isfile(path):
+        cached = torch.load(path)
+        if cached["config"] == config:
+            return cached["masks"]
+        logger.info("%s was built with other settings, rebuilding it" % path)
+
+    masks = stream.build_masks()
+    # ranks building the same file replace it whole.
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    torch.save({"config": config, "masks": masks}, tmp_path)
+    os.replace(tmp_path, path)
+    return masks
+
 
 class ConceptCapLoaderTrain(object):
     """
@@ -153,25 +739,35 @@ class ConceptCapLoaderTrain(object):
         visualization=False,
         span_mask=False,
         cond_mask=False,
-        region_len=36
+        region_len=36,
+        image_target_topk=0,
+        in_batch_negatives=False,
+        hard_negatives=False,
+        trim_padding=False,
+        bucket_batches=1,
+        shuffle_buffer=0,
+        cache_bytes=0,
+        seed=None
     ):
 
+        rank, world_size = 0, 1
         if dist.is_available() and distributed:
-            rank = dist.get_rank()
-            lmdb_file = os.path.join(corpus_path, "training_feat_part_" + str(rank) + ".lmdb")
-        else:
-            lmdb_file = os.path.join(corpus_path, "training_feat_all.lmdb")
-            
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        lmdb_files = training_shards(corpus_path, distributed=world_size > 1)
+
         caption_path = os.path.join(corpus_path, "caption_train.json")
+        caption_store = None
+        if is_caption_store(os.path.join(corpus_path, "caption_train.tokens")):
+            caption_store = CaptionStore(os.path.join(corpus_path, "caption_train.tokens"), tokenizer)
+            print("Loading captions from %s" % caption_store.path)
         
-        print("Loading from %s" % lmdb_file)
+        records = ShardedRecords(lmdb_files, rank, world_size)
+        print("Loading records %d to %d of %s" % (records.start, records.stop, ", ".join(lmdb_files)))
 
-        os.listdir(corpus_path)
-
-        ds = td.LMDBSerializer.load(lmdb_file, shuffle=False)
-        self.num_dataset = len(ds)
-        
+        self.num_dataset = len(records)
         self.cond_mask = cond_mask
+        if seed is None:
+            seed = np.random.randint(1 << 31)
 
         preprocess_function = BertPreprocessBatch(
             caption_path,
@@ -181,81 +777,82 @@ class ConceptCapLoaderTrain(object):
             self.num_dataset,
             encoding="utf-8",
             predict_feature=predict_feature,
-            span_mask=span_mask,
-            cond_mask=cond_mask
+            caption_store=caption_store,
+            image_target_topk=image_target_topk,
+            in_batch_negatives=in_batch_negatives,
+        )
+        self.masker = BatchMasker(tokenizer, span_mask=span_mask, cond_mask=cond_mask)
+        # the shared memory is mapped before the DataLoader starts its workers.
+        self.cache = RecordCache(self.num_dataset, cache_bytes, region_len) if cache_bytes > 0 else None
+
+        self.stream = ConceptCapStream(
+            records,
+            preprocess_function,
+            self.masker,
+            batch_size,
+            seed=seed,
+            trim_padding=trim_padding,
+            bucket_batches=bucket_batches,
+            shuffle_blocks=shuffle,
+            shuffle_buffer=shuffle_buffer,
+            cache=self.cache,
+            num_workers=num_workers,
+            in_batch_negatives=in_batch_negatives,
+            hard_negatives=hard_negatives,
+        )
+        self.loader = DataLoader(
+            self.stream,
+            batch_size=None,
+            num_workers=num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=num_workers > 0,
         )
-
-        # ds = td.LocallyShuffleData(ds, cache)
-        ds = td.PrefetchData(ds, 5000, 1)
-        ds = td.MapData(ds, preprocess_function)
-        # self.ds = td.PrefetchData(ds, 1)
-        ds = td.PrefetchDataZMQ(ds, num_workers)
-        self.ds = td.BatchData(ds, batch_size)
-        # self.ds = ds
-        self.ds.reset_state()
 
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self._consumed = [0] * max(num_workers, 1)
 
     def __iter__(self):
-        for batch in self.ds.get_data():
-            if self.cond_mask:
-                batches = [batch[:12], batch[12:]]
-                for batch in batches:
-                    input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                    image_loc, image_target, image_label, image_mask, multimodal_mask, image_id = batch
-
-                    batch_size = input_ids.shape[0]
-                    g_image_feat = np.sum(image_feat, axis=1) / np.sum(image_mask, axis=1, keepdims=True)
-                    image_feat = np.concatenate([np.expand_dims(g_image_feat, axis=1), image_feat], axis=1)
-                    image_feat = np.array(image_feat, dtype=np.float32)
-
-                    g_image_loc = np.repeat(np.array([[0,0,1,1,1]], dtype=np.float32), batch_size, axis=0)
-                    image_loc = np.concatenate([np.expand_dims(g_image_loc, axis=1), image_loc], axis=1)
-                    
-                    image_loc = np.array(image_loc, dtype=np.float32)
-                    g_image_mask = np.repeat(np.array([[1]]), batch_size, axis=0)
-                    image_mask = np.concatenate([g_image_mask, image_mask], axis=1)
-                    
-                    multimodal_mask = np.concatenate([g_image_mask, multimodal_mask], axis=1)
-
-                    # batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                    # image_loc, image_target, image_label, image_mask, image_id)
-                    batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                        image_loc, image_target, image_label, image_mask, multimodal_mask, image_id)
-                    
-                    b_tensor = [torch.tensor(data) for data in batch]
-                    yield tuple(b_tensor)
-            else:
-                input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                image_loc, image_target, image_label, image_mask, multimodal_mask, image_id = batch
-
-                batch_size = input_ids.shape[0]
-                g_image_feat = np.sum(image_feat, axis=1) / np.sum(image_mask, axis=1, keepdims=True)
-                image_feat = np.concatenate([np.expand_dims(g_image_feat, axis=1), image_feat], axis=1)
-                image_feat = np.array(image_feat, dtype=np.float32)
-
-                g_image_loc = np.repeat(np.array([[0,0,1,1,1]], dtype=np.float32), batch_size, axis=0)
-                image_loc = np.concatenate([np.expand_dims(g_image_loc, axis=1), image_loc], axis=1)
-                
-                image_loc = np.array(image_loc, dtype=np.float32)
-                g_image_mask = np.repeat(np.array([[1]]), batch_size, axis=0)
-                image_mask = np.concatenate([g_image_mask, image_mask], axis=1)
-                
-                multimodal_mask = np.concatenate([g_image_mask, multimodal_mask], axis=1)
-
-                # batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                # image_loc, image_target, image_label, image_mask, image_id)
-                batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                    image_loc, image_target, image_label, image_mask, multimodal_mask, image_id)
-                
-                b_tensor = [torch.tensor(data) for data in batch]
-                # yield tuple([torch.tensor(data) for data in batch] + [image_id])
-                # yield tuple([torch.tensor(data) for data in batch])
-                yield tuple(b_tensor)
+        self._consumed = list(self.stream._skip)
+        for worker_id, batch in self.loader:
+            views = cond_mask_views(batch) if self.cond_mask else [batch]
+            for view in views[:-1]:
+                yield view
+            # a batch counts as consumed once its last view is given, a state
+            # saved between the views has the whole batch given again.
+            self._consumed[worker_id] += 1
+            yield views[-1]
+        self.stream.fast_forward([0] * len(self._consumed))
+
+    def set_epoch(self, epoch):
+        """Draws new masks, NSP negatives and record order for the next pass, in the running workers."""
+        self.stream.set_epoch(epoch)
+
+    def state_dict(self):
+        """The position in the epoch: the batches every loader worker gave so far."""
+        return {
+            "seed": self.stream.seed,
+            "epoch": self.stream._epoch.value,
+            "num_workers": self.num_workers,
+            "consumed": list(self._consumed),
+        }
+
+    def load_state_dict(self, state):
+        """
+        Resumes a `state_dict`, the next pass goes on with the batches not
+        given yet. To be called before the first pass, with as many workers.
+        """
+        if state["num_workers"] != self.num_workers:
+            raise ValueError(
+                "the loader state was saved with %d workers, not %d" % (state["num_workers"], self.num_workers)
+            )
+        self.stream.seed = state["seed"]
+        self.stream.set_epoch(state["epoch"])
+        self.stream.fast_forward(state["consumed"])
+        self._consumed = list(state["consumed"])
 
     def __len__(self):
-        return self.ds.size()
+        return len(self.stream)
 
 class ConceptCapLoaderVal(object):
     """
@@ -278,6 +875,12 @@ class ConceptCapLoaderVal(object):
         cuda (bool, optional): set to ``True`` and the PyTorch tensors will get preloaded
             to the GPU for you (necessary because this lets us to uint8 conversion on the 
             GPU, which is faster).
+
+    The validation loader has no `set_epoch` and its stream stays on epoch 0.
+    Without `mask_cache` the masks and NSP captions are drawn from the seed,
+    random unless given, so every epoch of a run validates on the same
+    batches but each run on different ones. With `mask_cache` they are drawn
+    once, with seed 0 unless given, and replayed by every run.
     """
 
     def __init__(
@@ -297,20 +900,36 @@ class ConceptCapLoaderVal(object):
         visualization=False,
         span_mask=False,
         cond_mask=False,
-        region_len=36
+        region_len=36,
+        image_target_topk=0,
+        in_batch_negatives=False,
+        hard_negatives=False,
+        trim_padding=False,
+        bucket_batches=1,
+        shuffle_buffer=0,
+        cache_bytes=0,
+        mask_cache=None,
+        seed=None
     ):
     
         lmdb_file = os.path.join(corpus_path, "validation_all.lmdb")
+        records = ShardedRecords([lmdb_file])
 
         caption_path = os.path.join(corpus_path, "caption_val.json")
+        caption_store = None
+        if is_caption_store(os.path.join(corpus_path, "caption_val.tokens")):
+            caption_store = CaptionStore(os.path.join(corpus_path, "caption_val.tokens"), tokenizer)
+            print("Loading captions from %s" % caption_store.path)
 
         print("Loading from %s" % lmdb_file)
 
-        ds = td.LMDBSerializer.load(lmdb_file, shuffle=False)
-        self.num_dataset = len(ds)
+        self.num_dataset = len(records)
         
         self.cond_mask = cond_mask
-        
+        if seed is None:
+            # the cached masks are only valid for one seed.
+            seed = 0 if mask_cache is not None else np.random.randint(1 << 31)
+
         preprocess_function = BertPreprocessBatch(
             caption_path,
             tokenizer,
@@ -320,76 +939,64 @@ class ConceptCapLoaderVal(object):
             encoding="utf-8",
             predict_feature=predict_feature,
             visualization=visualization,
-            span_mask=span_mask, 
-            cond_mask=cond_mask,
+            caption_store=caption_store,
+            image_target_topk=image_target_topk,
+            in_batch_negatives=in_batch_negatives,
+        )
+        self.masker = BatchMasker(tokenizer, span_mask=span_mask, cond_mask=cond_mask, visualization=visualization)
+        self.cache = RecordCache(self.num_dataset, cache_bytes, region_len) if cache_bytes > 0 else None
+
+        self.stream = ConceptCapStream(
+            records,
+            preprocess_function,
+            self.masker,
+            batch_size,
+            seed=seed,
+            trim_padding=trim_padding,
+            bucket_batches=bucket_batches,
+            shuffle_blocks=shuffle,
+            shuffle_buffer=shuffle_buffer,
+            cache=self.cache,
+            num_workers=num_workers,
+            in_batch_negatives=in_batch_negatives,
+            hard_negatives=hard_negatives,
+        )
+        if mask_cache is not None:
+            config = {
+                "num_records": self.num_dataset,
+                "batch_size": batch_size,
+                "seq_len": seq_len,
+                "region_len": region_len,
+                "vocab_md5": vocab_checksum(tokenizer),
+                "seed": seed,
+                "span_mask": span_mask,
+                "cond_mask": cond_mask,
+                "visualization": visualization,
+                "in_batch_negatives": in_batch_negatives,
+                "trim_padding": trim_padding,
+            }
+            self.stream.masks = load_masks(mask_cache, self.stream, config)
+        self.loader = DataLoader(
+            self.stream,
+            batch_size=None,
+            num_workers=num_workers,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=num_workers > 0,
         )
-
-        ds = td.MapData(ds, preprocess_function)
-        self.ds = td.BatchData(ds, batch_size)
-        self.ds.reset_state()
 
         self.batch_size = batch_size
         self.num_workers = num_workers
 
     def __iter__(self):
-        for batch in self.ds.get_data():
+        for _, batch in self.loader:
             if self.cond_mask:
-                batches = [batch[:12], batch[12:]]
-                for batch in batches:
-                    input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                    image_loc, image_target, image_label, image_mask, multimodal_mask, image_id = batch
-
-                    batch_size = input_ids.shape[0]
-                    g_image_feat = np.sum(image_feat, axis=1) / np.sum(image_mask, axis=1, keepdims=True)
-                    image_feat = np.concatenate([np.expand_dims(g_image_feat, axis=1), image_feat], axis=1)
-                    image_feat = np.array(image_feat, dtype=np.float32)
-
-                    g_image_loc = np.repeat(np.array([[0,0,1,1,1]], dtype=np.float32), batch_size, axis=0)
-                    image_loc = np.concatenate([np.expand_dims(g_image_loc, axis=1), image_loc], axis=1)
-                    
-                    image_loc = np.array(image_loc, dtype=np.float32)
-                    g_image_mask = np.repeat(np.array([[1]]), batch_size, axis=0)
-                    image_mask = np.concatenate([g_image_mask, image_mask], axis=1)
-                    
-                    multimodal_mask = np.concatenate([g_image_mask, multimodal_mask], axis=1)
-
-                    # batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                    # image_loc, image_target, image_label, image_mask, image_id)
-                    batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                        image_loc, image_target, image_label, image_mask, multimodal_mask, image_id)
-                    
-                    b_tensor = [torch.tensor(data) for data in batch]
-                    yield tuple(b_tensor)
+                for view in cond_mask_views(batch):
+                    yield view
             else:
-                input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                image_loc, image_target, image_label, image_mask, multimodal_mask, image_id = batch
-
-                batch_size = input_ids.shape[0]
-                g_image_feat = np.sum(image_feat, axis=1) / np.sum(image_mask, axis=1, keepdims=True)
-                image_feat = np.concatenate([np.expand_dims(g_image_feat, axis=1), image_feat], axis=1)
-                image_feat = np.array(image_feat, dtype=np.float32)
-
-                g_image_loc = np.repeat(np.array([[0,0,1,1,1]], dtype=np.float32), batch_size, axis=0)
-                image_loc = np.concatenate([np.expand_dims(g_image_loc, axis=1), image_loc], axis=1)
-                
-                image_loc = np.array(image_loc, dtype=np.float32)
-                g_image_mask = np.repeat(np.array([[1]]), batch_size, axis=0)
-                image_mask = np.concatenate([g_image_mask, image_mask], axis=1)
-                
-                multimodal_mask = np.concatenate([g_image_mask, multimodal_mask], axis=1)
-
-                # batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                # image_loc, image_target, image_label, image_mask, image_id)
-                batch = (input_ids, input_mask, segment_ids, lm_label_ids, is_next, image_feat, \
-                    image_loc, image_target, image_label, image_mask, multimodal_mask, image_id)
-                
-                b_tensor = [torch.tensor(data) for data in batch]
-                # yield tuple([torch.tensor(data) for data in batch] + [image_id])
-                # yield tuple([torch.tensor(data) for data in batch])
-                yield tuple(b_tensor)
+                yield batch
 
     def __len__(self):
-        return self.ds.size()
+        return len(self.stream)
 
 
 class BertPreprocessBatch(object):
@@ -404,8 +1011,9 @@ class BertPreprocessBatch(object):
         encoding="utf-8",
         predict_feature=False,
         visualization=False,
-        span_mask=False, 
-        cond_mask=False
+        caption_store=None,
+        image_target_topk=0,
+        in_batch_negatives=False,
     ):
 
         self.split = split
@@ -415,104 +1023,110 @@ class BertPreprocessBatch(object):
         self.predict_feature = predict_feature
         # self.num_caps = data_size
         # self.captions = list(json.load(open(caption_path, 'r')).values())
-        self.captions = json.load(open(caption_path, 'r'))
-        self.all_pair_ids = list(self.captions.keys())
-        self.num_caps = len(self.captions)
+        self.caption_store = caption_store
+        if caption_store is None:
+            self.captions = json.load(open(caption_path, 'r'))
+            self.all_pair_ids = list(self.captions.keys())
+            self.num_caps = len(self.captions)
+        else:
+            self.num_caps = len(caption_store)
         self.visualization = visualization
-        self.span_mask = span_mask
-        self.cond_mask = cond_mask
-
-    def __call__(self, data):
+        self.image_target_topk = image_target_topk
+        # only positive pairs, the stream makes the negatives (`in_batch_negatives`).
+        self.in_batch_negatives = in_batch_negatives
+        self.rng = random.Random()
 
+    def new_batch(self, batch_size, num_regions=None):
+        """
+        Buffers of a batch for `fill`, in the order of the loader outputs plus
+        image_w and image_h. Row 0 of image_feat, image_loc, image_mask and
+        multimodal_mask is reserved for the global region. The regions are
+        padded to `num_regions`, by default `region_len`.
+        """
+        region_len = self.region_len if num_regions is None else num_regions
+        if self.predict_feature:
+            target_shape = (batch_size, region_len, 2048)
+        elif self.image_target_topk > 0:
+            target_shape = (batch_size, region_len, self.image_target_topk, 2)
+        else:
+            target_shape = (batch_size, region_len, 1601)
+        return [
+            np.zeros((batch_size, self.seq_len), dtype=np.int64),                        # input_ids
+            np.zeros((batch_size, self.seq_len), dtype=np.int64),                        # input_mask
+            np.zeros((batch_size, self.seq_len), dtype=np.int64),                        # segment_ids
+            np.full((batch_size, self.seq_len), -1, dtype=np.int64),                     # lm_label_ids
+            np.zeros(batch_size, dtype=np.int64),                                        # is_next
+            np.zeros((batch_size, region_len + 1, 2048), dtype=np.float32),              # image_feat
+            np.zeros((batch_size, region_len + 1, 5), dtype=np.float32),                 # image_loc
+            np.zeros(target_shape, dtype=np.float32),                                    # image_target
+            np.full((batch_size, region_len), -1, dtype=np.int64),                       # image_label
+            np.zeros((batch_size, region_len + 1), dtype=np.int64),                      # image_mask
+            np.zeros((batch_size, region_len + 1 + self.seq_len), dtype=np.int64),       # multimodal_mask
+            np.zeros(batch_size, dtype=np.int64),                                        # image_id
+            np.zeros(batch_size, dtype=np.float32),                                      # image_w
+            np.zeros(batch_size, dtype=np.float32),                                      # image_h
+        ]
+
+    def fill(self, batch, i, data):
+        """Writes the record `data` into row `i` of the buffers of `new_batch`, unmasked."""
+        self.fill_image(batch, i, data)
+        self.fill_text(batch, i, data)
+
+    def fill_image(self, batch, i, data):
+        """The image part of `fill`: the regions, their masks, the image id and size."""
         image_feature_wp, image_target_wp, image_location_wp, num_boxes, image_h, image_w, image_id, caption = data
-        
-        image_feature = np.zeros((self.region_len, 2048), dtype=np.float32)
-        image_target = np.zeros((self.region_len, 1601), dtype=np.float32)
-        image_location = np.zeros((self.region_len, 5), dtype=np.float32)
+        image_feat, image_loc, image_target = batch[5], batch[6], batch[7]
+        image_mask, multimodal_mask, image_ids, image_ws, image_hs = batch[9], batch[10], batch[11], batch[12], batch[13]
 
         num_boxes = int(num_boxes)
-        image_feature[:num_boxes] = image_feature_wp
-        image_target[:num_boxes] = image_target_wp
-        image_location[:num_boxes,:4] = image_location_wp
-
-        image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-        
-        image_location[:,0] = image_location[:,0] / float(image_w)
-        image_location[:,1] = image_location[:,1] / float(image_h)
-        image_location[:,2] = image_location[:,2] / float(image_w)
-        image_location[:,3] = image_location[:,3] / float(image_h)
-
+        num_regions = image_mask.shape[1] - 1
+        image_w = float(image_w)
+        image_h = float(image_h)
+        image_feat[i, 1:num_boxes + 1] = image_feature_wp
         if self.predict_feature:
-            image_feature = copy.deepcopy(image_feature)
-            image_target = copy.deepcopy(image_feature)
+            image_target[i, :num_boxes] = image_feature_wp
+        elif self.image_target_topk > 0:
+            image_target[i] = topk_image_target(image_target_wp, self.image_target_topk, num_regions)
         else:
-            image_feature = copy.deepcopy(image_feature)
-            image_target = copy.deepcopy(image_target)            
+            image_target[i, :num_boxes] = image_target_wp
+
+        location = image_loc[i, 1:num_boxes + 1]
+        location[:, :4] = image_location_wp
+        location[:, 4] = (location[:, 3] - location[:, 1]) * (location[:, 2] - location[:, 0]) / (image_w * image_h)
+        location[:, 0:4:2] /= image_w
+        location[:, 1:4:2] /= image_h
+
+        image_mask[i, 1:num_boxes + 1] = 1
+        multimodal_mask[i, 1:num_boxes + 1] = 1
+        image_ids[i] = int(image_id)
+        image_ws[i] = image_w
+        image_hs[i] = image_h
+
+    def fill_text(self, batch, i, data):
+        """The caption part of `fill`, the caption of another image for a NSP negative."""
+        image_id, caption = data[6], data[7]
+        input_ids, input_mask, is_next, multimodal_mask = batch[0], batch[1], batch[4], batch[10]
+        num_regions = batch[9].shape[1] - 1
 
         caption, label = self.random_cap(caption, image_id)
-
-        tokens_caption = self.tokenizer.tokenize(caption)
-        cur_example = InputExample(
-            image_feat=image_feature,
-            image_target=image_target,
-            caption=tokens_caption,
-            is_next=label,
-            image_loc=image_location,
-            num_boxes=num_boxes,
-            image_w=float(image_w),
-            image_h=float(image_h)
-        )
-
-        # transform sample to features
-        if self.cond_mask:
-            text_features = self.convert_example_to_features(cur_example, self.seq_len, self.tokenizer, self.region_len, text_cond_mask=True)
-            text_tensors = [
-                text_features.input_ids,
-                text_features.input_mask,
-                text_features.segment_ids,
-                text_features.lm_label_ids,
-                text_features.is_next,
-                text_features.image_feat,
-                text_features.image_loc,
-                text_features.image_target,
-                text_features.image_label,
-                text_features.image_mask,
-                text_features.multimodal_mask,
-                int(image_id),
-            ]
-            img_features = self.convert_example_to_features(cur_example, self.seq_len, self.tokenizer, self.region_len, image_cond_mask=True)
-            img_tensors = [
-                img_features.input_ids,
-                img_features.input_mask,
-                img_features.segment_ids,
-                img_features.lm_label_ids,
-                img_features.is_next,
-                img_features.image_feat,
-                img_features.image_loc,
-                img_features.image_target,
-                img_features.image_label,
-                img_features.image_mask,
-                img_features.multimodal_mask,
-                int(image_id),
-            ]
-            cur_tensors = tuple(text_tensors+img_tensors)
-        else:
-            cur_features = self.convert_example_to_features(cur_example, self.seq_len, self.tokenizer, self.region_len)
-            cur_tensors = (
-                cur_features.input_ids,
-                cur_features.input_mask,
-                cur_features.segment_ids,
-                cur_features.lm_label_ids,
-                cur_features.is_next,
-                cur_features.image_feat,
-                cur_features.image_loc,
-                cur_features.image_target,
-                cur_features.image_label,
-                cur_features.image_mask,
-                cur_features.multimodal_mask,
-                int(image_id),
-            )
-        return cur_tensors
+        if isinstance(caption, str):
+            caption = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(caption))
+        caption = caption[:self.seq_len - 2]
+        num_tokens = len(caption) + 2
+
+        input_ids[i, 0] = self.tokenizer.vocab["[CLS]"]
+        input_ids[i, 1:num_tokens - 1] = caption
+        input_ids[i, num_tokens - 1] = self.tokenizer.vocab["[SEP]"]
+        input_mask[i, :num_tokens] = 1
+        multimodal_mask[i, num_regions + 1:num_regions + 1 + num_tokens] = 1
+        is_next[i] = label
+
+    def sample_length(self, data):
+        """Number of regions plus caption tokens of a record, an estimate when the captions are not tokenized."""
+        num_boxes, image_id, caption = data[3], data[6], data[7]
+        if self.caption_store is not None and image_id in self.caption_store:
+            return int(num_boxes) + len(self.caption_store[image_id])
+        return int(num_boxes) + len(caption.split())
 
     def random_cap(self, caption, image_id):
         """
@@ -522,10 +1136,14 @@ class BertPreprocessBatch(object):
         :return: (str, str, int), sentence 1, sentence 2, isNextSentence Label
         """
 
-        if self.visualization:
+        if self.caption_store is not None and image_id in self.caption_store:
+            # the lmdb records hold the caption text, the store has it tokenized already.
+            caption = self.caption_store[image_id]
+
+        if self.visualization or self.in_batch_negatives:
             return caption, 0
 
-        if random.random() > 0.5:
+        if self.rng.random() > 0.5:
             label = 0
         else:
             caption = self.get_random_caption(image_id)
@@ -536,276 +1154,26 @@ class BertPreprocessBatch(object):
     def get_random_caption(self, image_id):
         """
         Get random caption from another document for nextSentence task.
-        :return: str, content of one line
+        :return: str, content of one line, or its token ids with a caption store
         """
         # Similar to original tf repo: This outer loop should rarely go for more than one iteration for large
         # corpora. However, just to be careful, we try to make sure that
         # the random document is not the same as the document we're processing.
 
         # add the hard negative mining objective here.
+        if self.caption_store is not None:
+            target_image_id = image_id
+            while target_image_id[:-1] == image_id[:-1]:
+                rand_doc_idx = self.rng.randint(0, self.num_caps - 1)
+                target_image_id = self.caption_store.key(rand_doc_idx)
+            return self.caption_store.tokens(rand_doc_idx)
+
         target_image_id = image_id
         while target_image_id[:-1] == image_id[:-1]: # ensure the sampled caption not matches with the image
-            rand_doc_idx = random.randint(0, self.num_caps - 1)
+            rand_doc_idx = self.rng.randint(0, self.num_caps - 1)
             target_image_id = self.all_pair_ids[rand_doc_idx]
         caption = self.captions[target_image_id]
 
 
         return caption
 
-    def convert_example_to_features(self, example, max_seq_length, tokenizer, max_region_length, text_cond_mask=False, image_cond_mask=False):
-        """
-        Convert a raw sample (pair of sentences as tokenized strings) into a proper training sample with
-        IDs, LM labels, input_mask, CLS and SEP tokens etc.
-        :param example: InputExample, containing sentence input as strings and is_next label
-        :param max_seq_length: int, maximum length of sequence.
-        :param tokenizer: Tokenizer
-        :return: InputFeatures, containing all inputs and labels of one sample as IDs (as used for model training)
-        """
-        image_feat = example.image_feat
-        caption = example.caption
-        image_loc = example.image_loc
-        image_target = example.image_target
-        image_w = example.image_w
-        image_h = example.image_h
-        num_boxes = int(example.num_boxes)
-        self._truncate_seq_pair(caption, max_seq_length - 2)
-        
-        caption, caption_label = self.random_word(caption, tokenizer, span_mask=self.span_mask, cond_mask=text_cond_mask)
-        image_feat, image_loc, image_label = self.random_region(image_feat, image_loc, num_boxes, span_mask=self.span_mask, cond_mask=image_cond_mask, image_w=image_w, image_h=image_h)
-
-        # concatenate lm labels and account for CLS, SEP, SEP
-        # lm_label_ids = ([-1] + caption_label + [-1] + image_label + [-1])
-        lm_label_ids = [-1] + caption_label + [-1]
-        # image_label = ([-1] + image_label)
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids: 0   0   0   0  0     0 0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambigiously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = []
-        segment_ids = []
-
-        tokens.append("[CLS]")
-        segment_ids.append(0)
-        # for i in range(36):
-        #     # tokens.append(0)
-        #     segment_ids.append(0)
-
-        # tokens.append("[SEP]")
-        # segment_ids.append(0)
-        for token in caption:
-            tokens.append(token)
-            segment_ids.append(0)
-        tokens.append("[SEP]")
-        segment_ids.append(0)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        # input_ids = input_ids[:1] input_ids[1:]
-        input_mask = [1] * (len(input_ids))
-        image_mask = [1] * (num_boxes)
-
-        # Zero-pad up to the visual sequence length.
-        while len(image_mask) < max_region_length:
-            image_mask.append(0)
-            image_label.append(-1)
-
-        # Zero-pad up to the sequence length.
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-            lm_label_ids.append(-1)
-
-        multimodal_mask = image_mask + input_mask
-        max_length = max_region_length + max_seq_length
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(multimodal_mask) == max_length
-        assert len(segment_ids) == max_seq_length
-        assert len(lm_label_ids) == max_seq_length
-        assert len(image_mask) == max_region_length
-        assert len(image_label) == max_region_length
-
-        # if example.guid < 5:
-        #     logger.info("*** Example ***")
-        #     logger.info("guid: %s" % (example.guid))
-        #     logger.info("tokens: %s" % " ".join(
-        #             [str(x) for x in tokens]))
-        #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-        #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-        #     logger.info(
-        #             "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-        #     logger.info("LM label: %s " % (lm_label_ids))
-        #     logger.info("Is next sentence label: %s " % (example.is_next))
-
-        features = InputFeatures(
-            input_ids=np.array(input_ids),
-            input_mask=np.array(input_mask),
-            segment_ids=np.array(segment_ids),
-            lm_label_ids=np.array(lm_label_ids),
-            is_next=np.array(example.is_next),
-            image_feat=image_feat,
-            image_target=image_target,
-            image_loc=image_loc,
-            image_label=np.array(image_label),
-            image_mask = np.array(image_mask),
-            multimodal_mask = np.array(multimodal_mask)
-        )
-        return features
-
-    def _truncate_seq_pair(self, tokens_b, max_length):
-        """Truncates a sequence pair in place to the maximum length."""
-
-        # This is a simple heuristic which will always truncate the longer sequence
-        # one token at a time. This makes more sense than truncating an equal percent
-        # of tokens from each, since if one sequence is very short then each token
-        # that's truncated likely contains more information than a longer sequence.
-        while True:
-            total_length = len(tokens_b)
-            if total_length <= max_length:
-                break
-
-            tokens_b.pop()
-
-    def random_word(self, tokens, tokenizer, span_mask=False, cond_mask=False):
-        """
-        Masking some random tokens for Language Model task with probabilities as in the original BERT paper.
-        :param tokens: list of str, tokenized sentence.
-        :param tokenizer: Tokenizer, object used for tokenization (we need it's vocab here)
-        :return: (list of str, list of int), masked tokens and related labels for LM prediction
-        """
-        output_label = []
-        
-        if cond_mask:
-            for i, token in enumerate(tokens):
-                output_label.append(-1)
-        else:
-            if span_mask:
-                num_spans = 1
-                span_range = int(len(tokens)*0.3)
-                span_positions = []
-                if span_range > 0:
-                    for i in range(num_spans):
-                        span_range = int(len(tokens)/num_spans)
-                        start = random.randint(span_range*i, span_range*(i+1))
-                        for j in range(random.randint(1,span_range)):
-                            if start + j <= len(tokens) - 1:
-                                span_positions.append(start + j)
-                            else:
-                                break
-                        
-                for i, token in enumerate(tokens):
-                    if i in span_positions:
-                        prob = random.random()
-                        if prob < 0.8:
-                        # 80% randomly change token to mask token
-                            tokens[i] ="[MASK]"
-                        elif prob < 0.9:
-                            tokens[i] = random.choice(list(tokenizer.vocab.items()))[0]
-                        # -> rest 10% randomly keep current token
-                        # append current token to output (we will predict these later)
-                        try:
-                            output_label.append(tokenizer.vocab[token])
-                        except KeyError:
-                            # For unknown words (should not occur with BPE vocab)
-                            output_label.append(tokenizer.vocab["[UNK]"])
-                            logger.warning(
-                                "Cannot find token '{}' in vocab. Using [UNK] instead".format(token)
-                            )
-                    else:
-                        # no masking token (will be ignored by loss function later)
-                        output_label.append(-1)
-            else:
-                for i, token in enumerate(tokens):
-                    prob = random.random()
-                    # mask token with 15% probability
-                    
-                    if prob < 0.15 and not self.visualization:
-                        prob /= 0.15
-
-                        # 80% randomly change token to mask token
-                        if prob < 0.8:
-                            tokens[i] = "[MASK]"
-
-                        # 10% randomly change token to random token
-                        elif prob < 0.9:
-                            tokens[i] = random.choice(list(tokenizer.vocab.items()))[0]
-
-                        # -> rest 10% randomly keep current token
-
-                        # append current token to output (we will predict these later)
-                        try:
-                            output_label.append(tokenizer.vocab[token])
-                        except KeyError:
-                            # For unknown words (should not occur with BPE vocab)
-                            output_label.append(tokenizer.vocab["[UNK]"])
-                            logger.warning(
-                                "Cannot find token '{}' in vocab. Using [UNK] instead".format(token)
-                            )
-                    else:
-                        # no masking token (will be ignored by loss function later)
-                        output_label.append(-1)
-
-        return tokens, output_label
-
-    def random_region(self, image_feat, image_loc, num_boxes, span_mask=False, cond_mask=False, image_w=None, image_h=None):
-        """
-        """
-        output_label = []
-
-        if cond_mask:
-            for i in range(num_boxes):
-                output_label.append(-1)
-        else:
-            if span_mask:
-                # image_center_horizontal, image_center_vertical = image_loc[:,2] - image_loc[:,0], image_loc[:,3] - image_loc[:,1]
-                # image_center = np.concatenate((image_center_horizontal[:, np.newaxis], image_center_vertical[:, np.newaxis]), axis=1)
-                # image_dist = distance.cdist(image_center, image_center, 'euclidean')
-                # _, image_topk = torch.topk(torch.tensor(image_dist), 3, largest=False)
-                # image_topk = image_topk.numpy()
-                iou = iou_numpy(image_loc, image_loc, image_w, image_h)
-                for i in range(num_boxes):
-                    prob = random.random()
-                    # if i in span_positions:
-                    if prob < 0.1 and not self.visualization:
-                        image_feat[iou[i] >= 0.4] = 0
-                for i in range(num_boxes):
-                    if image_feat[i].any() == 0:
-                        output_label.append(1)
-                    else:
-                        output_label.append(-1)
-            else:
-                for i in range(num_boxes):
-                    prob = random.random()
-                    # mask token with 15% probability
-                    if prob < 0.15 and not self.visualization:
-                        prob /= 0.15
-                        # 80% randomly change token to mask token
-                        if prob < 0.9:
-                            image_feat[i] = 0
-                        # -> rest 10% randomly keep current token
-                        # append current token to output (we will predict these later)
-                        output_label.append(1)
-                    else:
-                        # no masking token (will be ignored by loss function later)
-                        output_label.append(-1)
-
-        return image_feat, image_loc, output_label
\ No newline at end of file
@@ -10,6 +10,7 @@ import _pickle as cPickle
 
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from ._image_features_reader import ImageFeaturesH5Reader
+from ._feature_store import open_padded_region_store, padded_region_store_path
 import jsonlines
 import sys
 import pdb
@@ -53,6 +54,7 @@ class RetreivalDataset(Dataset):
         padding_index: int = 0,
         max_seq_length: int = 20,
         max_region_num: int = 37,
+        padded_regions: bool = False,
     ):
         # All the keys in `self._entries` would be present in `self._image_features_reader`
 
@@ -83,6 +85,16 @@ class RetreivalDataset(Dataset):
             print('loading entries from %s' %(cache_path))
             self._entries = cPickle.load(open(cache_path, "rb"))
 
+        # padded region inputs of every image, computed once instead of on every read.
+        self._padded_regions = None
+        if padded_regions:
+            regions_path = padded_region_store_path(
+                os.path.join(dataroot, "cache", task + '_' + split + '_' + str(max_region_num)), [image_features_reader])
+            # the reads of the store count as those of the features.
+            self._padded_regions = open_padded_region_store(
+                regions_path, self.image_id_list, self._read_regions, self._max_region_num,
+                stats=image_features_reader.stats)
+
     def tokenize(self):
         """Tokenizes the captions.
 
@@ -126,30 +138,25 @@ class RetreivalDataset(Dataset):
             entry["segment_ids"] = segment_ids
 
 
-    def __getitem__(self, index):
-        entry = self._entries[index]
-        image_id = entry["image_id"]
-
-        features, num_boxes, boxes, _ = self._image_features_reader[image_id]
-        
-        mix_num_boxes = min(int(num_boxes), self._max_region_num)
-        mix_boxes_pad = np.zeros((self._max_region_num, 5))
-        mix_features_pad = np.zeros((self._max_region_num, 2048))
+    def _read_regions(self, image_id):
+        features, num_boxes, boxes, _ = self._image_features_reader.get_many([image_id], max_boxes=self._max_region_num)
 
-        image_mask = [1] * (int(mix_num_boxes))
-        while len(image_mask) < self._max_region_num:
-            image_mask.append(0)
+        image_mask = np.zeros(self._max_region_num, dtype=np.int64)
+        image_mask[:num_boxes[0]] = 1
 
-        mix_boxes_pad[:mix_num_boxes] = boxes[:mix_num_boxes]
-        mix_features_pad[:mix_num_boxes] = features[:mix_num_boxes]
+        return features[0], boxes[0], image_mask, int(num_boxes[0])
 
-        features1 = torch.tensor(mix_features_pad).float()
-        image_mask1 = torch.tensor(image_mask).long()
-        spatials1 = torch.tensor(mix_boxes_pad).float()
+    def _load_regions(self, image_ids):
+        """Padded (features, image_mask, spatials) of several images, fetched in one call."""
+        if self._padded_regions is not None and all(image_id in self._padded_regions for image_id in image_ids):
+            features, spatials, image_mask, _ = self._padded_regions.get_many(image_ids)
+        else:
+            features, num_boxes, spatials, _ = self._image_features_reader.get_many(image_ids, max_boxes=self._max_region_num)
+            image_mask = (np.arange(self._max_region_num)[None, :] < num_boxes[:, None]).astype(np.int64)
+        self._image_features_reader.stats.add(region_slots=image_mask.size, region_rows=image_mask.sum())
+        return torch.from_numpy(features), torch.from_numpy(image_mask), torch.from_numpy(spatials)
 
-        caption1 = entry["token"]
-        input_mask1 = entry["input_mask"]
-        segment_ids1 = entry["segment_ids"]
+    def _sample_negatives(self, image_id):
         # negative samples.
         # 1: correct one, 2: random caption wrong, 3: random image wrong. 4: hard image wrong.
         
@@ -160,41 +167,12 @@ class RetreivalDataset(Dataset):
 
         entry2 = self._entries[random.choice(self.imgid2entry[img_id2])]
 
-        features2 = features1
-        image_mask2 = image_mask1
-        spatials2 = spatials1
-        caption2 = entry2["token"]
-        input_mask2 = entry2["input_mask"]
-        segment_ids2 = entry2["segment_ids"]        
-
         # random image wrong
         while True:
             # sample a random image:
             img_id3 = random.choice(self.image_id_list)
             if img_id3 != image_id: break        
 
-        features3, num_boxes3, boxes3, _ = self._image_features_reader[img_id3]
-        image_mask3 = [1] * (int(num_boxes3))
-
-        mix_num_boxes3 = min(int(num_boxes3), self._max_region_num)
-        mix_boxes_pad3 = np.zeros((self._max_region_num, 5))
-        mix_features_pad3 = np.zeros((self._max_region_num, 2048))
-
-        while len(image_mask3) < self._max_region_num:
-            image_mask3.append(0)        
-
-        mix_boxes_pad3[:mix_num_boxes3] = boxes3[:mix_num_boxes3]
-        mix_features_pad3[:mix_num_boxes3] = features3[:mix_num_boxes3]
-
-        features3 = torch.tensor(mix_features_pad3).float()
-        image_mask3 = torch.tensor(image_mask3).long()
-        spatials3 = torch.tensor(mix_boxes_pad3).float()
-
-        caption3 = caption1
-        input_mask3 = input_mask1
-        segment_ids3 = segment_ids1
-
-
         if self._split == 'train':
             # random hard caption.
             rand_img_id_pool = self.train_hard_pool[self.train_imgId2pool[image_id]]
@@ -208,26 +186,67 @@ class RetreivalDataset(Dataset):
 
         entry4 = self._entries[random.choice(self.imgid2entry[img_id4])]
 
-        features4 = features1
-        image_mask4 = image_mask1
-        spatials4 = spatials1
-        caption4 = entry4["token"]
-        input_mask4 = entry4["input_mask"]
-        segment_ids4 = entry4["segment_ids"]
-
-        features = torch.stack([features1, features2, features3, features4], dim=0)
-        spatials = torch.stack([spatials1, spatials2, spatials3, spatials4], dim=0)
-        image_mask = torch.stack([image_mask1, image_mask2, image_mask3, image_mask4], dim=0)
-        caption = torch.stack([caption1, caption2, caption3, caption4], dim=0)
-        input_mask = torch.stack([input_mask1, input_mask2, input_mask3, input_mask4], dim=0)
-        multimodal_mask = torch.cat((image_mask, input_mask), dim=-1)
-        segment_ids = torch.stack([segment_ids1, segment_ids2, segment_ids3, segment_ids4], dim=0)
-        co_attention_mask = torch.zeros((4, self._max_region_num, self._max_seq_length))
-        # target = 0
-        target = torch.ones(features.shape[0], dtype=torch.long)
-        target[0] = 0
-
-        return features, spatials, image_mask, caption, target, input_mask, segment_ids, co_attention_mask, multimodal_mask, image_id
+        return entry2, img_id3, entry4
+
+    def prefetch(self, index):
+        """Warms the regions of the image of `index`, see `PrefetchDataset`."""
+        image_id = self._entries[index]["image_id"]
+        if self._padded_regions is not None and image_id in self._padded_regions:
+            self._padded_regions.prefetch(image_id)
+        else:
+            self._image_features_reader.prefetch(image_id)
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        # the positive and random negative images of the whole minibatch are
+        # read with a single call to the feature reader.
+        entries = [self._entries[index] for index in indices]
+        negatives = [self._sample_negatives(entry["image_id"]) for entry in entries]
+
+        image_ids = [entry["image_id"] for entry in entries] + [img_id3 for _, img_id3, _ in negatives]
+        features_all, image_mask_all, spatials_all = self._load_regions(image_ids)
+
+        samples = []
+        for i, (entry, (entry2, img_id3, entry4)) in enumerate(zip(entries, negatives)):
+            features1 = features_all[i]
+            image_mask1 = image_mask_all[i]
+            spatials1 = spatials_all[i]
+            caption1 = entry["token"]
+            input_mask1 = entry["input_mask"]
+            segment_ids1 = entry["segment_ids"]
+
+            # random caption wrong
+            caption2 = entry2["token"]
+            input_mask2 = entry2["input_mask"]
+            segment_ids2 = entry2["segment_ids"]        
+
+            # random image wrong
+            features3 = features_all[len(entries) + i]
+            image_mask3 = image_mask_all[len(entries) + i]
+            spatials3 = spatials_all[len(entries) + i]
+
+            # hard caption wrong
+            caption4 = entry4["token"]
+            input_mask4 = entry4["input_mask"]
+            segment_ids4 = entry4["segment_ids"]
+
+            features = torch.stack([features1, features1, features3, features1], dim=0)
+            spatials = torch.stack([spatials1, spatials1, spatials3, spatials1], dim=0)
+            image_mask = torch.stack([image_mask1, image_mask1, image_mask3, image_mask1], dim=0)
+            caption = torch.stack([caption1, caption2, caption1, caption4], dim=0)
+            input_mask = torch.stack([input_mask1, input_mask2, input_mask1, input_mask4], dim=0)
+            multimodal_mask = torch.cat((image_mask, input_mask), dim=-1)
+            segment_ids = torch.stack([segment_ids1, segment_ids2, segment_ids1, segment_ids4], dim=0)
+            co_attention_mask = torch.zeros((4, self._max_region_num, self._max_seq_length))
+            # target = 0
+            target = torch.ones(features.shape[0], dtype=torch.long)
+            target[0] = 0
+
+            samples.append((features, spatials, image_mask, caption, target, input_mask, segment_ids, co_attention_mask, multimodal_mask, entry["image_id"]))
+
+        return samples
 
     def __len__(self):
         return len(self._entries)
@@ -268,9 +287,11 @@ class RetreivalDatasetVal(Dataset):
         padding_index: int = 0,
         max_seq_length: int = 20,
         max_region_num: int = 101,
+        padded_regions: bool = False,
     ):
         # All the keys in `self._entries` would be present in `self._image_features_reader`
 
+        # the test images are padded once below, so padded_regions is not used.
         self._image_entries, self._caption_entries = _load_annotationsVal(annotations_jsonpath, task)
         self._image_features_reader = image_features_reader
         self._tokenizer = tokenizer
@@ -284,34 +305,15 @@ class RetreivalDatasetVal(Dataset):
         self.tokenize()
         self.tensorize()
 
-        self.features_all = np.zeros((1000, self._max_region_num, 2048))
-        self.spatials_all = np.zeros((1000, self._max_region_num, 5))
-        self.image_mask_all = np.zeros((1000, self._max_region_num))
-
-        for i, image_id in enumerate(self._image_entries):
-            features, num_boxes, boxes, _ = self._image_features_reader[image_id]
-
-            mix_num_boxes = min(int(num_boxes), self._max_region_num)
-            mix_boxes_pad = np.zeros((self._max_region_num, 5))
-            mix_features_pad = np.zeros((self._max_region_num, 2048))
-
-            image_mask = [1] * (int(mix_num_boxes))
-            while len(image_mask) < self._max_region_num:
-                image_mask.append(0)
-
-            mix_boxes_pad[:mix_num_boxes] = boxes[:mix_num_boxes]
-            mix_features_pad[:mix_num_boxes] = features[:mix_num_boxes]
-
-            self.features_all[i] = mix_features_pad
-            self.image_mask_all[i] = np.array(image_mask)
-            self.spatials_all[i] = mix_boxes_pad
-
-            sys.stdout.write('%d/%d\r' % (i, len(self._image_entries)))
-            sys.stdout.flush()
+        # all the test images are read and padded with one batched call.
+        features_all, num_boxes_all, spatials_all, _ = self._image_features_reader.get_many(
+            self._image_entries[:1000], max_boxes=self._max_region_num
+        )
+        image_mask_all = np.arange(self._max_region_num)[None, :] < num_boxes_all[:, None]
 
-        self.features_all = torch.Tensor(self.features_all).float()
-        self.image_mask_all = torch.Tensor(self.image_mask_all).long()
-        self.spatials_all = torch.Tensor(self.spatials_all).float()
+        self.features_all = torch.from_numpy(features_all)
+        self.image_mask_all = torch.from_numpy(image_mask_all).long()
+        self.spatials_all = torch.from_numpy(spatials_all)
 
     def tokenize(self):
         """Tokenizes the captions.
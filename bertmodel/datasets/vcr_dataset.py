@@ -11,6 +11,7 @@ import json_lines
 
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from ._image_features_reader import ImageFeaturesH5Reader
+from ._feature_store import open_padded_region_store, padded_region_store_path
 import pdb
 import csv
 import sys
@@ -92,7 +93,8 @@ class VCRDataset(Dataset):
         tokenizer: BertTokenizer,
         padding_index: int = 0,
         max_seq_length: int = 40,
-        max_region_num: int = 60
+        max_region_num: int = 60,
+        padded_regions: bool = False,
     ):
         # All the keys in `self._entries` would be present in `self._image_features_reader`
         if task == 'VCR_Q-A':
@@ -130,6 +132,16 @@ class VCRDataset(Dataset):
         else:
             self._entries = cPickle.load(open(cache_path, "rb"))
 
+        # merged and padded region inputs of every image, computed once instead of on every read.
+        self._padded_regions = None
+        if padded_regions:
+            regions_path = padded_region_store_path(
+                "data/VCR/cache/" + split + "_" + str(max_region_num), [image_features_reader, gt_image_features_reader])
+            image_ids = sorted(set(entry["img_id"] for entry in self._entries))
+            # the reads of the store count as those of the features.
+            self._padded_regions = open_padded_region_store(
+                regions_path, image_ids, self._read_regions, self._max_region_num, stats=image_features_reader.stats)
+
     def tokenize(self):
         """Tokenizes the captions.
 
@@ -262,20 +274,27 @@ class VCRDataset(Dataset):
                 tokens_b.pop()
                 mask_b.pop()
 
-    def __getitem__(self, index):
-        
-        entry = self._entries[index]
-
-        image_id = entry["img_id"]
+    def _read_regions(self, image_id):
         features, num_boxes, boxes, _ = self._image_features_reader[image_id]
-
+        gt_features, gt_num_boxes, gt_boxes, _ = self._gt_image_features_reader[image_id]
+        return self._merge_regions(features, num_boxes, boxes, gt_features, gt_num_boxes, gt_boxes)
+
+    def _read_regions_many(self, image_ids):
+        # both stores are read once for the whole batch, the merge is per image.
+        features, num_boxes, boxes, _ = self._image_features_reader.get_many(image_ids)
+        gt_features, gt_num_boxes, gt_boxes, _ = self._gt_image_features_reader.get_many(image_ids)
+        return [
+            self._merge_regions(features[i], int(num_boxes[i]), boxes[i], gt_features[i], int(gt_num_boxes[i]), gt_boxes[i])
+            for i in range(len(image_ids))
+        ]
+
+    def _merge_regions(self, features, num_boxes, boxes, gt_features, gt_num_boxes, gt_boxes):
         boxes = boxes[:num_boxes]
         features = features[:num_boxes]
 
-        gt_features, gt_num_boxes, gt_boxes, _ = self._gt_image_features_reader[image_id]
-
-        # merge two features.
-        features[0] = (features[0] * num_boxes + gt_features[0] * gt_num_boxes) / (num_boxes + gt_num_boxes)
+        # merge two features. the reader may hand out shared or read-only arrays,
+        # so the merged global feature is written into the concatenated copy below.
+        g_feat = (features[0].astype(np.float32) * num_boxes + gt_features[0].astype(np.float32) * gt_num_boxes) / (num_boxes + gt_num_boxes)
 
         # merge two boxes, and assign the labels. 
         gt_boxes = gt_boxes[1:gt_num_boxes]
@@ -294,22 +313,56 @@ class VCRDataset(Dataset):
         # concatenate the boxes
         mix_boxes = np.concatenate((boxes, gt_boxes), axis=0)
         mix_features = np.concatenate((features, gt_features), axis=0)
+        if num_box_preserve > 0:
+            mix_features[0] = g_feat
         mix_num_boxes = num_box_preserve + int(gt_num_boxes)
         
-        image_mask = [1] * (mix_num_boxes)
-        while len(image_mask) < self._max_region_num:
-            image_mask.append(0)
+        image_mask = np.zeros(self._max_region_num, dtype=np.int64)
+        image_mask[:mix_num_boxes] = 1
 
-        mix_boxes_pad = np.zeros((self._max_region_num, 5))
-        mix_features_pad = np.zeros((self._max_region_num, 2048))
+        mix_boxes_pad = np.zeros((self._max_region_num, 5), dtype=np.float32)
+        # float16 features (see ImageFeaturesMmapReader) are kept as they are.
+        mix_features_pad = np.zeros((self._max_region_num, 2048), dtype=mix_features.dtype)
 
         mix_boxes_pad[:mix_num_boxes] = mix_boxes[:mix_num_boxes]
         mix_features_pad[:mix_num_boxes] = mix_features[:mix_num_boxes]
 
+        # num_box_preserve is stored in place of the number of boxes, the
+        # co-attention mask is offset by it.
+        return mix_features_pad, mix_boxes_pad, image_mask, num_box_preserve
+
+    def prefetch(self, index):
+        """Warms the regions of the image of `index`, see `PrefetchDataset`."""
+        image_id = self._entries[index]["img_id"]
+        if self._padded_regions is not None:
+            self._padded_regions.prefetch(image_id)
+        else:
+            self._image_features_reader.prefetch(image_id)
+            self._gt_image_features_reader.prefetch(image_id)
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        entries = [self._entries[index] for index in indices]
+        image_ids = [entry["img_id"] for entry in entries]
+        if self._padded_regions is not None:
+            features, spatials, image_mask, num_box_preserve = self._padded_regions.get_many(image_ids)
+            regions = zip(features, spatials, image_mask, num_box_preserve)
+        else:
+            regions = self._read_regions_many(image_ids)
+
+        samples = [self._make_sample(entry, *region) for entry, region in zip(entries, regions)]
+        self._image_features_reader.stats.add(
+            region_slots=len(samples) * self._max_region_num, region_rows=sum(int(sample[2].sum()) for sample in samples))
+        return samples
+
+    def _make_sample(self, entry, features, spatials, image_mask, num_box_preserve):
         # appending the target feature.
-        features = torch.tensor(mix_features_pad).float()
-        image_mask = torch.tensor(image_mask).long()
-        spatials = torch.tensor(mix_boxes_pad).float()
+        features = torch.tensor(features)
+        image_mask = torch.tensor(image_mask)
+        spatials = torch.tensor(spatials)
+        num_box_preserve = int(num_box_preserve)
 
         input_ids = entry["input_ids"]
         input_mask = entry["input_mask"]
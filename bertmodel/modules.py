@@ -1427,6 +1427,15 @@ class InterBertForMultiModalPreTraining(BertPreTrainedModel):
                 masked_img_loss = torch.sum(
                     img_loss * (image_label == 1).unsqueeze(2).float() * (next_sentence_label == 0).unsqueeze(1).unsqueeze(2).float()
                 ) / max(torch.sum((image_label == 1) * (next_sentence_label == 0).unsqueeze(1)),1)
+            elif image_target.dim() == 4:
+                # top-k targets [batch, regions, k, (class, probability)], only the masked rows are densified.
+                rows = ((image_label == 1) * (next_sentence_label == 0).unsqueeze(1)).nonzero(as_tuple=True)
+                log_probs = F.log_softmax(prediction_scores_v[rows], dim=1)
+                topk_target = image_target[rows]
+                dense_target = log_probs.new_zeros(log_probs.shape).scatter_add_(
+                    1, topk_target[:, :, 0].long(), topk_target[:, :, 1].to(log_probs.dtype)
+                )
+                masked_img_loss = torch.sum(self.vis_criterion(log_probs, dense_target)) / max(log_probs.shape[0], 1)
             else:
                 img_loss = self.vis_criterion(
                     F.log_softmax(prediction_scores_v, dim=2), image_target
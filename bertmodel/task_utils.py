@@ -14,6 +14,9 @@ from torch.utils.data.distributed import DistributedSampler
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from bertmodel.datasets import DatasetMapTrain, DatasetMapEval
 from bertmodel.datasets._image_features_reader import ImageFeaturesH5Reader
+from bertmodel.datasets._feature_store import ImageFeaturesMmapReader, is_feature_store
+from bertmodel.datasets._prefetch import PrefetchDataset, PrefetchSampler
+from bertmodel.datasets._shared_cache import default_capacity_bytes
 import pdb
 
 logger = logging.getLogger(__name__)
@@ -23,9 +26,51 @@ LossMap = {'BCEWithLogitLoss': nn.BCEWithLogitsLoss(reduction='mean'),
             }
 binary_prediction_lossfct = CrossEntropyLoss(ignore_index=-1)            
 
+# readers built by LoadFeaturesReader, keyed by features path.
+_feature_readers = {}
+
+def _local_world_size(args):
+    # the number of processes of the job on this node, set by torch.distributed.launch and torchrun.
+    if args.local_rank == -1:
+        return 1
+    return int(os.environ.get('LOCAL_WORLD_SIZE', max(torch.cuda.device_count(), 1)))
+
+def _num_feature_caches(args, features_paths):
+    # every in_memory lmdb reader of every process on the node maps its own cache.
+    if not args.in_memory:
+        return 0
+    num_readers = sum(1 for path in features_paths if path != '' and not is_feature_store(path))
+    return _local_world_size(args) * num_readers
+
+def LoadFeaturesReader(args, features_path, max_boxes, num_caches=1):
+    # memory-mapped stores written by convert_features.py are read without decoding.
+    # quantized features stay float16 through the DataLoader and are cast on the device.
+    if is_feature_store(features_path):
+        reader = ImageFeaturesMmapReader(features_path, args.in_memory, dequantize=False)
+    else:
+        # without --cache_size_gb the caches of the node share a quarter of its memory.
+        if args.cache_size_gb > 0:
+            cache_bytes = int(args.cache_size_gb * (1 << 30))
+        else:
+            cache_bytes = default_capacity_bytes(num_caches)
+        reader = ImageFeaturesH5Reader(features_path, args.in_memory, cache_bytes=cache_bytes, max_boxes=max_boxes)
+
+    _feature_readers[features_path] = reader
+    return reader
+
+def FeatureReaderStats():
+    """The counters of the feature readers loaded so far, keyed by features file name."""
+    return {os.path.basename(path.rstrip('/')): reader.stats for path, reader in _feature_readers.items()}
+
+def _max_region_num(task_cfg, ids, features_key, features_path):
+    # number of regions (plus the global one) worth caching for a feature file.
+    return max(task_cfg['TASK' + task_id]['max_region_num'] for task_id in ids
+               if task_cfg['TASK' + task_id][features_key] == features_path) + 1
+
 def ForwardModelsVal(args, task_cfg, device, task_id, batch, model, task_losses):
     batch = tuple(t.cuda(device=device, non_blocking=True) for t in batch)
     features, spatials, image_mask, question, target, input_mask, segment_ids, co_attention_mask, multimodal_mask, question_id = batch
+    features = features.float()
     batch_size = features.size(0)
 
     if task_id in ['TASK1', 'TASK2']:
@@ -80,6 +125,7 @@ def ForwardModelsTrain(args, task_cfg, device, task_id, task_count, task_iter_tr
     batch = task_iter_train[task_id].next()
     batch = tuple(t.cuda(device=device, non_blocking=True) for t in batch)
     features, spatials, image_mask, question, target, input_mask, segment_ids, co_attention_mask, multimodal_mask, question_id = batch
+    features = features.float()
     batch_size = features.size(0)
 
     if task_id in ['TASK1', 'TASK2']:
@@ -155,15 +201,17 @@ def LoadDatasets(args, task_cfg, ids, split='trainval'):
             task_feature_reader2[task_cfg[task]['features_h5path2']] = None
 
     # initialize the feature reader
+    num_caches = _num_feature_caches(args, list(task_feature_reader1) + list(task_feature_reader2))
     for features_h5path in task_feature_reader1.keys():
         print(features_h5path)
         if features_h5path != '':
-            task_feature_reader1[features_h5path] = ImageFeaturesH5Reader(features_h5path, 
-                                                                            args.in_memory)
+            task_feature_reader1[features_h5path] = LoadFeaturesReader(
+                args, features_h5path, _max_region_num(task_cfg, ids, 'features_h5path1', features_h5path), num_caches)
     
     for features_h5path in task_feature_reader2.keys():
         if features_h5path != '':
-            task_feature_reader2[features_h5path] = ImageFeaturesH5Reader(features_h5path, args.in_memory)
+            task_feature_reader2[features_h5path] = LoadFeaturesReader(
+                args, features_h5path, _max_region_num(task_cfg, ids, 'features_h5path2', features_h5path), num_caches)
     
     task_datasets_train = {}
     task_datasets_val = {}
@@ -198,6 +246,7 @@ def LoadDatasets(args, task_cfg, ids, split='trainval'):
                                 padding_index=0,
                                 max_seq_length=task_cfg[task]['max_seq_length'],
                                 max_region_num=task_cfg[task]['max_region_num'],
+                                padded_regions=task_cfg[task].get('padded_regions', False),
                                 )
 
         task_datasets_val[task] = None
@@ -212,7 +261,8 @@ def LoadDatasets(args, task_cfg, ids, split='trainval'):
                                 tokenizer=tokenizer, 
                                 padding_index=0,
                                 max_seq_length=task_cfg[task]['max_seq_length'],
-                                max_region_num=task_cfg[task]['max_region_num'])
+                                max_region_num=task_cfg[task]['max_region_num'],
+                                padded_regions=task_cfg[task].get('padded_regions', False))
 
         task_num_iters[task] = 0
         task_batch_size[task] = 0
@@ -224,14 +274,20 @@ def LoadDatasets(args, task_cfg, ids, split='trainval'):
                 # (it doesn't return item back by index)
                 train_sampler = DistributedSampler(task_datasets_train[task])
 
+            train_dataset = task_datasets_train[task]
+            sampler_args = dict(sampler=train_sampler, batch_size=batch_size)
+            if args.prefetch_images > 0:
+                # the workers warm the images of the upcoming indices while they read a batch.
+                train_dataset = PrefetchDataset(train_dataset)
+                sampler_args = dict(batch_sampler=PrefetchSampler(train_sampler, batch_size, lookahead=args.prefetch_images))
+
             # num_workers = 1
             task_dataloader_train[task] = DataLoader(
-                task_datasets_train[task],
-                sampler=train_sampler,
+                train_dataset,
                 # shuffle=False,
-                batch_size=batch_size,
                 num_workers=num_workers,
                 pin_memory=True,
+                **sampler_args
             )
             task_num_iters[task] = len(task_dataloader_train[task])
             task_batch_size[task] = batch_size
@@ -264,14 +320,16 @@ def LoadDatasetEval(args, task_cfg, ids):
             task_feature_reader2[task_cfg[task]['features_h5path2']] = None
 
     # initilzie the feature reader
+    num_caches = _num_feature_caches(args, list(task_feature_reader1) + list(task_feature_reader2))
     for features_h5path in task_feature_reader1.keys():
         if features_h5path != '':
-            task_feature_reader1[features_h5path] = ImageFeaturesH5Reader(features_h5path, 
-                                                                            args.in_memory)
+            task_feature_reader1[features_h5path] = LoadFeaturesReader(
+                args, features_h5path, _max_region_num(task_cfg, ids, 'features_h5path1', features_h5path), num_caches)
     
     for features_h5path in task_feature_reader2.keys():
         if features_h5path != '':
-            task_feature_reader2[features_h5path] = ImageFeaturesH5Reader(features_h5path, args.in_memory)
+            task_feature_reader2[features_h5path] = LoadFeaturesReader(
+                args, features_h5path, _max_region_num(task_cfg, ids, 'features_h5path2', features_h5path), num_caches)
     
     task_datasets_val = {}
     task_dataloader_val = {}
@@ -304,7 +362,8 @@ def LoadDatasetEval(args, task_cfg, ids):
                             tokenizer=tokenizer, 
                             padding_index=0,
                             max_seq_length=task_cfg[task]['max_seq_length'],
-                            max_region_num=task_cfg[task]['max_region_num'])
+                            max_region_num=task_cfg[task]['max_region_num'],
+                            padded_regions=task_cfg[task].get('padded_regions', False))
         
         task_dataloader_val[task] = DataLoader(
             task_datasets_val[task],
@@ -330,6 +389,7 @@ def compute_score_with_logits(logits, labels):
 def EvaluatingModel(args, task_cfg, device, task_id, batch, model, task_dataloader, task_losses, results, others):
     batch = tuple(t.cuda(device=device, non_blocking=True) for t in batch)
     features, spatials, image_mask, question, target, input_mask, segment_ids, co_attention_mask, multimodal_mask,question_id = batch
+    features = features.float()
     batch_size = features.size(0)
 
     if task_id in ['TASK1', 'TASK2']:
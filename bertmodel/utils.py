@@ -62,6 +62,8 @@ class tbLogger(object):
         self.task_score_val = {task_id:0 for task_id in task_ids}
         self.task_step_val = {task_id:0 for task_id in task_ids}
         self.task_datasize_val = {task_id:0 for task_id in task_ids}
+        self.reader_stats = {}
+        self.reader_counts = {}
 
     def txt_close(self):
         self.txt_f.close()
@@ -113,6 +115,32 @@ class tbLogger(object):
         print(lossInfo, file=self.txt_f)
         return ave_score
 
+    def addReaderStats(self, name, stats):
+        # feature reader counters (see datasets._telemetry), shown with the training loss.
+        self.reader_stats[name] = stats
+        self.reader_counts[name] = stats.snapshot()
+
+    def showReaderStats(self):
+        stepId = max(self.task_step.values())
+        for name, stats in self.reader_stats.items():
+            counts = stats.snapshot()
+            delta = counts - self.reader_counts[name]
+            self.reader_counts[name] = counts
+            summary = stats.summary(delta)
+
+            readerInfo = '[%s]: reads %d %.1f MB prefetch %.1f MB decode %.1f us/read hit %.3f pad waste %.3f workers' %(name, \
+                summary['reads'], summary['MB'], summary['prefetch_MB'], summary['decode_us_per_read'], summary['hit_rate'], summary['pad_waste'])
+            # reads / decode ms of every worker that read something, worker -1 is the main process.
+            for row in range(delta.shape[0]):
+                if delta[row].any():
+                    worker = stats.summary(delta[row:row + 1])
+                    readerInfo += ' %d:%d/%.1f' %(row - 1, worker['reads'], worker['decode_ms'])
+
+            logger.info(readerInfo)
+            print(readerInfo, file=self.txt_f)
+            for key, val in summary.items():
+                self.linePlot(stepId, val, 'reader', name + '_' + key)
+
     def showLossTrain(self):
         # show the current loss, once showed, reset the loss. 
         lossInfo = ''
@@ -127,6 +155,7 @@ class tbLogger(object):
         
         logger.info(lossInfo)
         print(lossInfo, file=self.txt_f)
+        self.showReaderStats()
 
         self.task_step_tmp = {task_id:0 for task_id in self.task_ids}
         self.task_loss_tmp = {task_id:0 for task_id in self.task_ids}
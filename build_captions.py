@@ -0,0 +1,56 @@
+import argparse
+import logging
+import os
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+from bertmodel.datasets._caption_store import build_caption_store
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--data_dir",
+        required=True,
+        type=str,
+        help="The pretraining data dir holding caption_train.json / caption_val.json.",
+    )
+    parser.add_argument(
+        "--splits",
+        default=["train", "val"],
+        nargs="+",
+        type=str,
+        help="Caption files to tokenize, caption_<split>.json is written to caption_<split>.tokens.",
+    )
+    parser.add_argument(
+        "--bert_model",
+        default="bert-base-uncased",
+        type=str,
+        help="Bert pre-trained model whose vocabulary is used, the same as for train_concap.py.",
+    )
+    parser.add_argument(
+        "--do_lower_case",
+        type=bool,
+        default=True,
+        help="Whether to lower case the input text. True for uncased models, False for cased models.",
+    )
+    args = parser.parse_args()
+
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    for split in args.splits:
+        caption_path = os.path.join(args.data_dir, "caption_%s.json" % split)
+        output_path = os.path.join(args.data_dir, "caption_%s.tokens" % split)
+        num_captions = build_caption_store(caption_path, output_path, tokenizer)
+        logger.info("Tokenized %d captions of %s to %s" % (num_captions, caption_path, output_path))
+
+
+if __name__ == "__main__":
+    main()
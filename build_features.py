@@ -0,0 +1,230 @@
+import argparse
+import base64
+import csv
+import glob
+import logging
+import os
+import pickle
+import sys
+from multiprocessing import Pool
+
+import lmdb
+import numpy as np
+
+from bertmodel.datasets._image_features_reader import ImageFeaturesH5Reader
+from bertmodel.datasets._feature_store import FeatureStoreWriter, FEATURE_DTYPES, is_feature_store
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+csv.field_size_limit(sys.maxsize)
+TSV_FIELDNAMES = ["image_id", "image_w", "image_h", "num_boxes", "boxes", "features"]
+
+
+def _npz_field(data, *names):
+    for name in names:
+        if name in data:
+            return data[name]
+    # some extraction scripts keep the image size in a pickled "info" dict.
+    if "info" in data:
+        info = data["info"].item()
+        for name in names:
+            if name in info:
+                return info[name]
+    raise KeyError("none of %s in the npz file" % ", ".join(names))
+
+
+def _load_npz(path):
+    data = np.load(path, allow_pickle=True)
+    features = np.asarray(_npz_field(data, "features", "x"), dtype=np.float32)
+    boxes = np.asarray(_npz_field(data, "boxes", "bbox"), dtype=np.float32)
+    return {
+        "image_id": os.path.splitext(os.path.basename(path))[0],
+        "image_h": int(_npz_field(data, "image_h", "image_height")),
+        "image_w": int(_npz_field(data, "image_w", "image_width")),
+        "num_boxes": features.shape[0],
+        "boxes": base64.b64encode(np.ascontiguousarray(boxes).tobytes()),
+        "features": base64.b64encode(np.ascontiguousarray(features).tobytes()),
+    }
+
+
+def _load_tsv_row(row):
+    # bottom-up-attention rows hold the boxes and features base64 encoded already.
+    item = {
+        "image_id": row["image_id"],
+        "image_h": int(row["image_h"]),
+        "image_w": int(row["image_w"]),
+        "num_boxes": int(row["num_boxes"]),
+        "boxes": row["boxes"].encode(),
+        "features": row["features"].encode(),
+    }
+    return item
+
+
+def _check(item, feature_size):
+    num_boxes = item["num_boxes"]
+    assert len(base64.b64decode(item["features"])) == num_boxes * feature_size * 4, \
+        "image %s: features do not match num_boxes" % item["image_id"]
+    assert len(base64.b64decode(item["boxes"])) == num_boxes * 4 * 4, \
+        "image %s: boxes do not match num_boxes" % item["image_id"]
+
+
+class _Encoder(object):
+    """Turns one input (npz path or tsv row) into (key, record), run in the pool."""
+    def __init__(self, output_format, feature_size):
+        self.output_format = output_format
+        self.feature_size = feature_size
+
+    def __call__(self, source):
+        item = _load_npz(source) if isinstance(source, str) else _load_tsv_row(source)
+        _check(item, self.feature_size)
+        key = str(item["image_id"]).encode()
+        if self.output_format == "lmdb":
+            return key, pickle.dumps(item)
+        features, _, image_location, image_location_ori = ImageFeaturesH5Reader.decode(item)
+        return key, (features, image_location, image_location_ori)
+
+
+def _sources(inputs, writer):
+    for path in inputs:
+        if os.path.isdir(path) or path.endswith(".npz"):
+            npz_paths = sorted(glob.glob(os.path.join(path, "*.npz"))) if os.path.isdir(path) else [path]
+            for npz_path in npz_paths:
+                # the id of an npz file is its name, images already in the store are not even loaded.
+                if os.path.splitext(os.path.basename(npz_path))[0].encode() not in writer:
+                    yield npz_path
+        else:
+            with open(path, "r") as f:
+                for row in csv.DictReader(f, delimiter="\t", fieldnames=TSV_FIELDNAMES):
+                    yield row
+
+
+class LmdbFeaturesWriter(object):
+    """
+    Writes the lmdb layout read by `ImageFeaturesH5Reader`: one pickled record
+    per image under its id, plus the list of ids under "keys". With `append`
+    the new images are added to an existing store and only the "keys" entry is
+    rewritten.
+    """
+    def __init__(self, path, append=False, map_size=1 << 40, commit_every=1000):
+        if os.path.exists(path) and not append:
+            raise ValueError("%s already exists, use --append to add images to it" % path)
+        self.env = lmdb.open(path, map_size=map_size, subdir=True, meminit=False, map_async=True)
+        self.commit_every = commit_every
+
+        self._keys = []
+        with self.env.begin(write=False) as txn:
+            keys = txn.get("keys".encode())
+            if keys is not None:
+                self._keys = pickle.loads(keys)
+        self._key_set = set(self._keys)
+        self._txn = self.env.begin(write=True)
+        self._pending = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._key_set
+
+    def add(self, key, record):
+        self._txn.put(key, record)
+        self._keys.append(key)
+        self._key_set.add(key)
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._txn.commit()
+            self._txn = self.env.begin(write=True)
+            self._pending = 0
+
+    def close(self):
+        # the keys are written last, an interrupted build keeps the previous list.
+        self._txn.put("keys".encode(), pickle.dumps(self._keys))
+        self._txn.commit()
+        self.env.sync()
+        self.env.close()
+
+
+class _MmapFeaturesWriter(FeatureStoreWriter):
+    """FeatureStoreWriter with the (key, record) interface of LmdbFeaturesWriter."""
+    def __contains__(self, key):
+        return key in self._key_set
+
+    def add(self, key, record):
+        features, image_location, image_location_ori = record
+        super(_MmapFeaturesWriter, self).add(key.decode(), features, image_location, image_location_ori)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--inputs",
+        required=True,
+        nargs="+",
+        type=str,
+        help="bottom-up-attention outputs: tsv files, npz files or directories of npz files.",
+    )
+    parser.add_argument(
+        "--output_path",
+        required=True,
+        type=str,
+        help="The feature store to write, e.g. data/flickr30k/flickr30k_resnet101_faster_rcnn_genome.lmdb.",
+    )
+    parser.add_argument(
+        "--output_format",
+        default="lmdb",
+        choices=["lmdb", "mmap"],
+        help="lmdb store, or the memory-mapped store of convert_features.py.",
+    )
+    parser.add_argument(
+        "--append", action="store_true", help="add the images to an existing store, images already in it are skipped."
+    )
+    parser.add_argument(
+        "--num_workers", default=8, type=int, help="Number of encoder processes."
+    )
+    parser.add_argument(
+        "--feature_size", default=2048, type=int, help="Dimension of the region features."
+    )
+    parser.add_argument(
+        "--dtype",
+        default="float32",
+        choices=FEATURE_DTYPES,
+        help="Encoding of the features of a mmap store.",
+    )
+    args = parser.parse_args()
+
+    if args.output_format == "lmdb":
+        writer = LmdbFeaturesWriter(args.output_path, append=args.append)
+    else:
+        if is_feature_store(args.output_path) and not args.append:
+            raise ValueError("%s already exists, use --append to add images to it" % args.output_path)
+        writer = _MmapFeaturesWriter(args.output_path, feature_size=args.feature_size, append=args.append, dtype=args.dtype)
+    logger.info("Writing to %s, %d images already in the store" % (args.output_path, len(writer)))
+
+    encoder = _Encoder(args.output_format, args.feature_size)
+    num_added = 0
+    num_skipped = 0
+    with Pool(args.num_workers) as pool:
+        for i, (key, record) in enumerate(pool.imap(encoder, _sources(args.inputs, writer), chunksize=16)):
+            if key in writer:
+                num_skipped += 1
+                continue
+            writer.add(key, record)
+            num_added += 1
+
+            if i % 1000 == 0:
+                sys.stdout.write('%d\r' % i)
+                sys.stdout.flush()
+    writer.close()
+
+    logger.info("Added %d images to %s, skipped %d already present" % (num_added, args.output_path, num_skipped))
+
+
+if __name__ == "__main__":
+
+    main()
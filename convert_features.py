@@ -0,0 +1,95 @@
+import argparse
+import logging
+import sys
+
+from bertmodel.datasets._image_features_reader import ImageFeaturesH5Reader
+from bertmodel.datasets._feature_store import FeatureStoreWriter, FEATURE_DTYPES, raw_feature_block
+from bertmodel.datasets._block_codec import BLOCK_COMPRESSIONS, train_dictionary
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def convert(lmdb_path, output_path, feature_size=2048, dtype="float32",
+            compression=None, level=3, shuffle=True, dict_size=0, dict_samples=1000):
+    reader = ImageFeaturesH5Reader(lmdb_path)
+    image_ids = reader.keys()
+    logger.info("Converting %d images from %s to %s" % (len(image_ids), lmdb_path, dtype))
+
+    dictionary = None
+    if compression is not None and dict_size > 0:
+        # the dictionary is trained on the blocks of evenly spaced images.
+        step = max(len(image_ids) // dict_samples, 1)
+        samples = [raw_feature_block(reader[image_id.decode()][0], dtype, shuffle) for image_id in image_ids[::step]]
+        dictionary = train_dictionary(samples, dict_size)
+        logger.info("Trained a %d bytes dictionary on %d images" % (len(dictionary), len(samples)))
+
+    with FeatureStoreWriter(output_path, feature_size=feature_size, dtype=dtype, compression=compression,
+                            level=level, dictionary=dictionary, shuffle=shuffle) as writer:
+        for i, image_id in enumerate(image_ids):
+            image_id = image_id.decode()
+            features, num_boxes, image_location, image_location_ori = reader[image_id]
+            writer.add(image_id, features, image_location, image_location_ori)
+
+            if i % 1000 == 0:
+                sys.stdout.write('%d/%d\r' % (i, len(image_ids)))
+                sys.stdout.flush()
+
+    logger.info("Wrote %d images to %s" % (len(image_ids), output_path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--lmdb_path",
+        required=True,
+        type=str,
+        help="The *_resnet101_faster_rcnn_genome.lmdb feature store to convert.",
+    )
+    parser.add_argument(
+        "--output_path",
+        required=True,
+        type=str,
+        help="The directory of the memory-mapped feature store to write.",
+    )
+    parser.add_argument(
+        "--feature_size", default=2048, type=int, help="Dimension of the region features."
+    )
+    parser.add_argument(
+        "--dtype",
+        default="float32",
+        choices=FEATURE_DTYPES,
+        help="Encoding of the stored features, int8 uses one scale per region.",
+    )
+    parser.add_argument(
+        "--compression",
+        default=None,
+        choices=BLOCK_COMPRESSIONS,
+        help="Losslessly compress the features of every image as a zstd or lz4 block.",
+    )
+    parser.add_argument(
+        "--level", default=3, type=int, help="zstd level, or lz4 high compression level (0 for the fast mode)."
+    )
+    parser.add_argument(
+        "--no_shuffle", action="store_true", help="Do not byte-shuffle the features before compressing them."
+    )
+    parser.add_argument(
+        "--dict_size", default=0, type=int, help="Size of the shared compression dictionary in bytes, 0 for none."
+    )
+    parser.add_argument(
+        "--dict_samples", default=1000, type=int, help="Number of images to train the dictionary on."
+    )
+    args = parser.parse_args()
+
+    convert(args.lmdb_path, args.output_path, args.feature_size, args.dtype,
+            args.compression, args.level, not args.no_shuffle, args.dict_size, args.dict_samples)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import copy
+import logging
+import os
+import random
+import sys
+import numpy as np
+
+import yaml
+from easydict import EasyDict as edict
+
+import torch
+
+from bertmodel.task_utils import LoadDatasetEval, LoadLosses, EvaluatingModel
+from bertmodel.datasets._feature_store import is_feature_store
+from convert_features import convert
+
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+def quantized_path(features_path, dtype):
+    return os.path.splitext(features_path.rstrip('/'))[0] + '_' + dtype + '.mmap'
+
+
+def store_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def quantize_task_cfg(task_cfg, task, dtype, feature_size):
+    """Copy of the config of `task` reading the `dtype` stores, which are built if missing."""
+    task_cfg = copy.deepcopy(task_cfg)
+    for key in ['features_h5path1', 'features_h5path2']:
+        features_path = task_cfg[task][key]
+        if features_path == '':
+            continue
+        output_path = quantized_path(features_path, dtype)
+        if not is_feature_store(output_path):
+            convert(features_path, output_path, feature_size, dtype)
+        logger.info("%s: %.1f MB -> %.1f MB" % (output_path, store_size(features_path) / 2**20, store_size(output_path) / 2**20))
+        task_cfg[task][key] = output_path
+    return task_cfg
+
+
+def evaluate_multiple_choice(args, task_cfg, device, task, model, dataloader, task_losses):
+    score = 0.
+    count = 0
+    for i, batch in enumerate(dataloader):
+        if args.max_batches > 0 and i >= args.max_batches:
+            break
+        _, batch_score, batch_size, _, _ = EvaluatingModel(args, task_cfg, device, task, batch, model, None, task_losses, [], [])
+        score += batch_score
+        count += batch_size
+
+        sys.stdout.write('%d/%d\r' % (i, len(dataloader)))
+        sys.stdout.flush()
+
+    return {'accuracy': 100.0 * score / count}
+
+
+def evaluate_retrieval(args, device, model, dataloader):
+    # same scoring as eval_retrieval.py: every caption against the 1000 test images.
+    num_captions = len(dataloader.dataset) // 2
+    score_matrix = np.zeros((num_captions, 1000))
+    target_matrix = np.zeros((num_captions, 1000))
+    ranks = []
+    for i, batch in enumerate(dataloader):
+        if args.max_batches > 0 and i >= args.max_batches:
+            break
+        batch = tuple(t.cuda(device=device, non_blocking=True) for t in batch)
+        features, spatials, image_mask, question, target, input_mask, segment_ids, caption_idx, image_idx = batch
+        features = features.float().squeeze(0)
+        spatials = spatials.squeeze(0)
+        image_mask = image_mask.squeeze(0)
+        multimodal_mask = torch.cat((image_mask, input_mask.expand(image_mask.size(0), -1)), dim=-1)
+        question = question.expand(features.size(0), -1)
+
+        with torch.no_grad():
+            _, _, vil_logit, _, _, _, _ = model(question, features, spatials, segment_ids, input_mask, image_mask, multimodal_mask=multimodal_mask)
+
+        score_matrix[caption_idx, image_idx*500:(image_idx+1)*500] = torch.softmax(vil_logit, dim=1)[:,0].view(-1).cpu().numpy()
+        target_matrix[caption_idx, image_idx*500:(image_idx+1)*500] = target.view(-1).float().cpu().numpy()
+        if image_idx.item() == 1:
+            order = np.argsort(-score_matrix[caption_idx].reshape(-1))
+            ranks.append(np.where(order == np.where(target_matrix[caption_idx].reshape(-1) == 1)[0][0])[0][0])
+
+        sys.stdout.write('%d/%d\r' % (i, len(dataloader)))
+        sys.stdout.flush()
+
+    ranks = np.array(ranks)
+    return {
+        'r1': 100.0 * np.mean(ranks < 1),
+        'r5': 100.0 * np.mean(ranks < 5),
+        'r10': 100.0 * np.mean(ranks < 10),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--bert_model",
+        default="bert-base-uncased",
+        type=str,
+        help="Bert pre-trained model selected in the list: bert-base-uncased, "
+        "bert-large-uncased, bert-base-cased, bert-base-multilingual, bert-base-chinese.",
+    )
+    parser.add_argument(
+        "--from_pretrained",
+        default="bert-base-uncased",
+        type=str,
+        help="The fine-tuned model to evaluate.",
+    )
+    parser.add_argument(
+        "--config_file",
+        default="config/bert_base_6layer_interbert.json",
+        type=str,
+        help="The config file which specified the model details.",
+    )
+    parser.add_argument(
+        "--no_cuda", action="store_true", help="Whether not to use CUDA when available"
+    )
+    parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
+    parser.add_argument(
+        "--num_workers", type=int, default=10, help="Number of workers in the dataloader."
+    )
+    parser.add_argument(
+        "--batch_size", default=64, type=int, help="batch size of the VCR tasks, retrieval uses 1."
+    )
+    parser.add_argument(
+        "--tasks", default='1-2-3', type=str, help="1-2-3... tasks to evaluate separate by -"
+    )
+    parser.add_argument(
+        "--dtypes", default='float16-int8', type=str, help="feature encodings to compare with float32, separate by -"
+    )
+    parser.add_argument(
+        "--feature_size", default=2048, type=int, help="Dimension of the region features."
+    )
+    parser.add_argument(
+        "--max_batches", default=-1, type=int, help="only evaluate the first batches of every task, -1 for all."
+    )
+    parser.add_argument(
+        "--in_memory", default=False, type=bool, help="whether use chunck for parallel training."
+    )
+    parser.add_argument(
+        "--cache_size_gb", default=0, type=float, help="memory budget of every in_memory feature cache, 0 to split a quarter of the physical memory between the caches of all the processes of the node."
+    )
+    parser.add_argument(
+        "--split", default="", type=str, help="which split to use."
+    )
+
+    args = parser.parse_args()
+    args.local_rank = -1
+    with open('interbert_tasks.yml', 'r') as f:
+        task_cfg = edict(yaml.safe_load(f))
+
+    from bertmodel.modules import BertConfig
+    from bertmodel.modules import InterBertForVLTasks
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    config = BertConfig.from_json_file(args.config_file)
+    config.fast_mode = True
+
+    dtypes = ['float32'] + args.dtypes.split('-')
+    metrics = {}
+    for task_id in args.tasks.split('-'):
+        task = 'TASK' + task_id
+        task_losses = LoadLosses(args, task_cfg, [task_id])
+        task_args = copy.copy(args)
+        if task_cfg[task]['name'].startswith('Retrieval'):
+            task_args.batch_size = 1
+
+        # the head depends on the task, the model is built once per task for all the dtypes.
+        model = None
+
+        for dtype in dtypes:
+            random.seed(args.seed)
+            np.random.seed(args.seed)
+            torch.manual_seed(args.seed)
+
+            if dtype == 'float32':
+                dtype_cfg = task_cfg
+            else:
+                dtype_cfg = quantize_task_cfg(task_cfg, task, dtype, args.feature_size)
+            _, _, _, task_datasets_val, task_dataloader_val = LoadDatasetEval(task_args, dtype_cfg, [task_id])
+
+            if model is None:
+                num_labels = task_datasets_val[task].num_labels
+                model = InterBertForVLTasks.from_pretrained(args.from_pretrained, config, num_labels=num_labels)
+                model.to(device)
+                model.eval()
+
+            logger.info("Evaluating %s with %s features" % (task_cfg[task]['name'], dtype))
+            if task_args.batch_size == 1:
+                metrics[task, dtype] = evaluate_retrieval(task_args, device, model, task_dataloader_val[task])
+            else:
+                metrics[task, dtype] = evaluate_multiple_choice(
+                    task_args, dtype_cfg, device, task, model, task_dataloader_val[task], task_losses)
+
+    print("************************************************")
+    for task_id in args.tasks.split('-'):
+        task = 'TASK' + task_id
+        reference = metrics[task, 'float32']
+        for dtype in dtypes:
+            print("%s %s: %s" % (task_cfg[task]['name'], dtype, ", ".join(
+                "%s %.3f (%+.3f)" % (name, value, value - reference[name]) for name, value in metrics[task, dtype].items())))
+    print("************************************************")
+
+if __name__ == "__main__":
+    main()
@@ -100,6 +100,9 @@ def main():
     parser.add_argument(
         "--in_memory", default=False, type=bool, help="whether use chunck for parallel training."
     )
+    parser.add_argument(
+        "--cache_size_gb", default=0, type=float, help="memory budget of every in_memory feature cache, 0 to split a quarter of the physical memory between the caches of all the processes of the node."
+    )
     parser.add_argument(
         "--zero_shot", action="store_true", help="whether use single stream baseline."
     )
@@ -207,6 +210,7 @@ def main():
         for i, batch in enumerate(task_dataloader_val[task_id]):
             batch = tuple(t.cuda(device=device, non_blocking=True) for t in batch)
             features, spatials, image_mask, question, target, input_mask, segment_ids, caption_idx, image_idx = batch
+            features = features.float()
 
             if task_id in ['TASK3']:
                 batch_size = features.size(0)
@@ -104,6 +104,9 @@ def main():
     parser.add_argument(
         "--in_memory", default=False, type=bool, help="whether use chunck for parallel training."
     )
+    parser.add_argument(
+        "--cache_size_gb", default=0, type=float, help="memory budget of every in_memory feature cache, 0 to split a quarter of the physical memory between the caches of all the processes of the node."
+    )
     parser.add_argument(
         "--split", default="", type=str, help="which split to use."
     )
@@ -6,7 +6,6 @@ import random
 from io import open
 import math
 import sys
-import gc
 
 from time import gmtime, strftime
 from timeit import default_timer as timer
@@ -94,6 +93,12 @@ def main():
         "than this will be padded.",
     )
     parser.add_argument("--predict_feature", action="store_true", help="visual target.")
+    parser.add_argument(
+        "--image_target_topk",
+        default=0,
+        type=int,
+        help="Load only the k most likely classes of every region as the visual target, 0 for the dense 1601 classes.",
+    )
 
     parser.add_argument(
         "--train_batch_size",
@@ -206,7 +211,67 @@ def main():
         "--cond_mask", action="store_true" , help="Whether to use conditional masking method."
     )
     parser.add_argument(
-        "--dynamic_masking", action="store_true" , help="whether to use dynamic masking"
+        "--dynamic_masking", action="store_true" , help="whether to rebuild the training loader every epoch. "
+        "No longer needed, the masks and NSP negatives are drawn anew every epoch either way."
+    )
+    parser.add_argument(
+        "--in_batch_negatives",
+        action="store_true",
+        help="Load only matching pairs and make the ITM negatives by swapping captions within the batch in the loader workers.",
+    )
+    parser.add_argument(
+        "--hard_negatives",
+        action="store_true",
+        help="With --in_batch_negatives, swap in the caption of the most similar image of the batch.",
+    )
+    parser.add_argument(
+        "--trim_padding",
+        action="store_true",
+        help="Pad the regions and the text of every batch to its longest image and caption only.",
+    )
+    parser.add_argument(
+        "--bucket_batches",
+        default=1,
+        type=int,
+        help="Number of batches of records sorted by length together, to group images and captions of similar length.",
+    )
+    parser.add_argument(
+        "--shuffle_blocks",
+        action="store_true",
+        help="Read the blocks of --bucket_batches batches of the training data in a new order every epoch.",
+    )
+    parser.add_argument(
+        "--shuffle_buffer",
+        default=0,
+        type=int,
+        help="Number of training records every loader worker holds to shuffle them.",
+    )
+    parser.add_argument(
+        "--record_cache_gb",
+        default=0,
+        type=float,
+        help="Shared memory in GB to keep decoded training records in after the first epoch, 0 to read them all from lmdb.",
+    )
+    parser.add_argument(
+        "--val_mask_cache",
+        default="",
+        type=str,
+        help="File to keep the masks and NSP captions of the validation set in, built if missing. "
+        "The validation batches are then the same in every epoch and run.",
+    )
+    parser.add_argument(
+        "--checkpoint_steps",
+        default=0,
+        type=int,
+        help="Save the model, the optimizer and the position in the training data to checkpoint.bin "
+        "every this many optimizer steps, 0 to save at the end of the epochs only.",
+    )
+    parser.add_argument(
+        "--resume_checkpoint",
+        default="",
+        type=str,
+        help="A checkpoint.bin of --checkpoint_steps to resume the pretraining from, in the middle of its epoch. "
+        "Needs as many GPUs and --num_workers.",
     )
     args = parser.parse_args()
 
@@ -288,7 +353,15 @@ def main():
         num_workers=args.num_workers,
         distributed=args.distributed,
         span_mask=args.span_mask, 
-        cond_mask=args.cond_mask
+        cond_mask=args.cond_mask,
+        image_target_topk=args.image_target_topk,
+        in_batch_negatives=args.in_batch_negatives,
+        hard_negatives=args.hard_negatives,
+        trim_padding=args.trim_padding,
+        bucket_batches=args.bucket_batches,
+        shuffle=args.shuffle_blocks,
+        shuffle_buffer=args.shuffle_buffer,
+        cache_bytes=int(args.record_cache_gb * (1 << 30)),
     )
 
     validation_dataset = ConceptCapLoaderVal(
@@ -300,11 +373,30 @@ def main():
         num_workers=2,
         distributed=args.distributed,
         span_mask=args.span_mask, 
-        cond_mask=args.cond_mask
-    )
+        cond_mask=args.cond_mask,
+        image_target_topk=args.image_target_topk,
+        in_batch_negatives=args.in_batch_negatives,
+        hard_negatives=args.hard_negatives,
+        trim_padding=args.trim_padding,
+        mask_cache=args.val_mask_cache or None,
+    )
+
+    resume = None
+    if args.resume_checkpoint:
+        resume = torch.load(args.resume_checkpoint, map_location="cpu")
+        args.start_epoch = resume["epoch"]
+        # every rank goes on from its own position in its records.
+        rank, world_size = 0, 1
+        if dist.is_available() and args.distributed:
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        if len(resume["data"]) != world_size:
+            raise ValueError(
+                "the checkpoint was saved with %d ranks, not %d" % (len(resume["data"]), world_size)
+            )
+        train_dataset.load_state_dict(resume["data"][rank])
 
-    if args.continue_training:
-        assert args.start_epoch > 0 # must have pretrained at least one epoch
+    if args.continue_training or resume is not None:
+        assert resume is not None or args.start_epoch > 0 # must have pretrained at least one epoch
         num_train_optimization_steps = (
             int(
                 train_dataset.num_dataset
@@ -325,6 +417,8 @@ def main():
         )
         if args.cond_mask:
             finished_steps *= 2
+        if resume is not None:
+            finished_steps = resume["global_step"]
     else:        
         num_train_optimization_steps = (
             int(
@@ -370,6 +464,9 @@ def main():
     else:
         model = InterBertForMultiModalPreTraining(config)
 
+    if resume is not None:
+        model.load_state_dict(resume["model"])
+
     model.cuda()
 
     if args.fp16:
@@ -485,12 +582,18 @@ def main():
             )
             optimizer.load_state_dict(torch.load(opt_state_dict_path, map_location='cpu'))
 
+    if resume is not None:
+        optimizer.load_state_dict(resume["optimizer"])
+
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", train_dataset.num_dataset)
     logger.info("  Batch size = %d", args.train_batch_size)
     logger.info("  Num steps = %d", num_train_optimization_steps - finished_steps)
 
     startIterID = 0
+    if resume is not None:
+        # the steps of the batches the resumed epoch already went through.
+        startIterID = sum(train_dataset.state_dict()["consumed"]) * (2 if args.cond_mask else 1)
     global_step = finished_steps
     masked_loss_v_tmp = 0
     masked_loss_t_tmp = 0
@@ -499,6 +602,8 @@ def main():
     start_t = timer()
 
     for epochId in range(int(args.start_epoch), int(args.num_train_epochs)):
+        # the running workers draw the masks, NSP negatives and shuffling from the epoch.
+        train_dataset.set_epoch(epochId)
         model.train()
         tr_loss = 0
         nb_tr_examples, nb_tr_steps = 0, 0
@@ -588,6 +693,17 @@ def main():
                 optimizer.zero_grad()
                 global_step += 1
 
+                if args.checkpoint_steps > 0 and global_step % args.checkpoint_steps == 0:
+                    # the ranks read different records, the checkpoint keeps the position of each.
+                    data_states = [train_dataset.state_dict()]
+                    if dist.is_available() and args.distributed:
+                        data_states = [None] * dist.get_world_size()
+                        dist.all_gather_object(data_states, train_dataset.state_dict())
+                    if default_gpu:
+                        save_checkpoint(
+                            os.path.join(savePath, "checkpoint.bin"), model, optimizer, data_states, epochId, global_step
+                        )
+
             if step % 20 == 0 and step != 0:
                 masked_loss_t_tmp = masked_loss_t_tmp / 20.0
                 masked_loss_v_tmp = masked_loss_v_tmp / 20.0
@@ -620,6 +736,8 @@ def main():
                 next_sentence_loss_tmp = 0
                 loss_tmp = 0
 
+        startIterID = 0
+
         # Do the evaluation 
         torch.set_grad_enabled(False)    
         start_t = timer()
@@ -708,19 +826,24 @@ def main():
             )
             torch.save(optimizer.state_dict(), output_opt_state_dict_file)
             
-        if args.dynamic_masking and epochId + 1 < int(args.num_train_epochs):
-            del train_dataset
-            gc.collect()
-            train_dataset = ConceptCapLoaderTrain(
-                args.train_data_dir,
-                tokenizer,
-                seq_len=args.max_seq_length,
-                batch_size=args.train_batch_size,
-                predict_feature=args.predict_feature,
-                num_workers=args.num_workers,
-                distributed=args.distributed,
-                span_mask=args.span_mask
-            )
+        if train_dataset.cache is not None:
+            logger.info("record cache: %s" % train_dataset.cache.stats())
+
+def save_checkpoint(path, model, optimizer, data_states, epoch, global_step):
+    """Saves what --resume_checkpoint needs to go on from the current step, with the loader state of every rank."""
+    model_to_save = model.module if hasattr(model, "module") else model
+    checkpoint = {
+        "model": model_to_save.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "data": data_states,
+        "epoch": epoch,
+        "global_step": global_step,
+    }
+    # a crash while saving leaves the previous checkpoint.
+    torch.save(checkpoint, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    logger.info("Saved the checkpoint of step %d to %s" % (global_step, path))
+
 
 class TBlogger:
     def __init__(self, log_dir, exp_name):
@@ -20,7 +20,7 @@ import torch.nn as nn
 
 from pytorch_pretrained_bert.optimization import WarmupLinearSchedule
 
-from bertmodel.task_utils import LoadDatasets, LoadLosses, ForwardModelsTrain, ForwardModelsVal
+from bertmodel.task_utils import LoadDatasets, LoadLosses, ForwardModelsTrain, ForwardModelsVal, FeatureReaderStats
 from bertmodel.optimization import BertAdam, Adam, Adamax
 from torch.optim.lr_scheduler import LambdaLR, ReduceLROnPlateau
 
@@ -123,6 +123,12 @@ def main():
     parser.add_argument(
         "--in_memory", default=False, type=bool, help="whether use chunck for parallel training."
     )
+    parser.add_argument(
+        "--cache_size_gb", default=0, type=float, help="memory budget of every in_memory feature cache, 0 to split a quarter of the physical memory between the caches of all the processes of the node."
+    )
+    parser.add_argument(
+        "--prefetch_images", default=0, type=int, help="number of upcoming training images to prefetch in the background, 0 to disable."
+    )
     parser.add_argument(
         "--optimizer", default='BertAdam', type=str, help="whether use chunck for parallel training."
     )
@@ -222,6 +228,8 @@ def main():
         print('Error!')
 
     tbLogger = utils.tbLogger(timeStamp, savePath, task_names, task_ids, task_num_iters, args.gradient_accumulation_steps)
+    for name, stats in FeatureReaderStats().items():
+        tbLogger.addReaderStats(name, stats)
 
     # if n_gpu > 0:
         # torch.cuda.manual_seed_all(args.seed)